@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from settings import settings
+
+from metrics import metrics
+
+# 音声ファイルの保存先（空なら無効）
+CACHE_DIR = settings.get("MUSIC_AUDIO_CACHE_DIR", "")
+# 保存先の合計サイズの上限（MB、超えたら古く使われていないものから消す）
+CACHE_MAX_MB = settings.get_float("MUSIC_AUDIO_CACHE_MAX_MB", 1024)
+# これより長い曲は保存しない（秒、0で無制限）
+MAX_DURATION = settings.get_int("MUSIC_AUDIO_CACHE_MAX_DURATION", 1200)
+# 1曲の保存にかけてよい時間（秒）
+DOWNLOAD_TIMEOUT = 600
+# Opus 以外の音声を変換するときのビットレート
+OPUS_BITRATE = "128k"
+
+EXTENSION = ".opus"
+
+
+class AudioCache:
+    """先読みした曲を Ogg Opus で保存しておくキャッシュ（合計バイト数で LRU）"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        # ファイル名 -> サイズ（古く使われたものが先頭）
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(EXTENSION):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+            elif name.endswith(".part"):
+                # 前回の途中で終わったファイル
+                os.remove(path)
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + EXTENSION
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._files.values())
+
+    def __contains__(self, key: str) -> bool:
+        return self._name(key) in self._files
+
+    def get(self, key: str) -> Optional[str]:
+        """保存済みならファイルのパスを返す"""
+        name = self._name(key)
+        if name not in self._files:
+            self.misses += 1
+            return None
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            del self._files[name]
+            self.misses += 1
+            return None
+
+        self._files.move_to_end(name)
+        # 再起動後も使われた順番がわかるように更新日時を触っておく
+        os.utime(path)
+        self.hits += 1
+        return path
+
+    def schedule(self, key: str, stream: dict, duration: int = 0) -> None:
+        """まだ保存していなければバックグラウンドで保存を始める"""
+        name = self._name(key)
+        if name in self._files or name in self._pending:
+            return
+        if MAX_DURATION and duration and duration > MAX_DURATION:
+            return
+        task = asyncio.create_task(self._download(name, stream))
+        self._pending[name] = task
+        task.add_done_callback(lambda _: self._pending.pop(name, None))
+
+    async def _download(self, name: str, stream: dict) -> None:
+        path = os.path.join(self.directory, name)
+        part = path + ".part"
+        # 元が Opus ならコンテナだけ入れ替える（再エンコードしない）
+        codec = ["-c:a", "copy"] if stream.get("acodec") == "opus" else ["-c:a", "libopus", "-b:a", OPUS_BITRATE]
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+            "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+            "-i", stream["url"], "-vn", "-map", "0:a:0", *codec, "-f", "ogg", part,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), DOWNLOAD_TIMEOUT)
+        except BaseException as e:
+            # タイムアウト・キャンセル時は ffmpeg を止めて途中のファイルを消す
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if os.path.exists(part):
+                os.remove(part)
+            if not isinstance(e, asyncio.TimeoutError):
+                raise
+            self.failures += 1
+            print(f"音声キャッシュの保存がタイムアウトしました: {name}")
+            return
+
+        if process.returncode != 0:
+            if os.path.exists(part):
+                os.remove(part)
+            self.failures += 1
+            print(f"音声キャッシュの保存エラー: {stderr.decode(errors='replace').strip()[:200]}")
+            return
+
+        os.replace(part, path)
+        self._files[name] = os.path.getsize(path)
+        self._files.move_to_end(name)
+        self._evict()
+
+    def _evict(self) -> None:
+        total = self.total_bytes
+        while total > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._files),
+            "bytes": self.total_bytes,
+            "downloading": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+        }
+
+
+# MUSIC_AUDIO_CACHE_DIR が設定されている場合のみ有効
+cache: Optional[AudioCache] = AudioCache(CACHE_DIR, int(CACHE_MAX_MB * 1024 * 1024)) if CACHE_DIR else None
+if cache is not None:
+    metrics.add_collector("audio_cache", cache.stats)
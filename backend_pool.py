@@ -0,0 +1,162 @@
+import time
+from typing import Iterable, List, Optional, Set
+
+from settings import settings
+
+# 振り分け方（"least": 処理中の少ない順 / "latency": 処理中の数 × 平均応答時間 の小さい順）
+ROUTING = settings.get("OLLAMA_ROUTING", "least")
+# 連続でこの回数失敗したサーバーは一時的に使わない（サーキットブレーカー）
+CIRCUIT_THRESHOLD = settings.get_int("OLLAMA_CIRCUIT_THRESHOLD", 3)
+# 使わない期間（秒）。過ぎたら1件だけ試しに送る
+CIRCUIT_COOLDOWN = settings.get_float("OLLAMA_CIRCUIT_COOLDOWN", 30)
+# 応答時間の移動平均の重み
+LATENCY_ALPHA = 0.2
+
+
+class Backend:
+    """1台の Ollama サーバーの状態"""
+
+    def __init__(self, base_url: str, models: Optional[Set[str]] = None):
+        # "http://host:11434/api/generate" の形式で渡されてもよい
+        self.base_url = base_url.split("/api/", 1)[0].rstrip("/")
+        # 設定で指定したモデル（None なら全モデル）
+        self.models = models
+        # /api/tags で確認できたモデル（ヘルスチェック前は None）
+        self.discovered: Optional[Set[str]] = None
+        self.outstanding = 0
+        self.latency = 0.0
+        self.healthy = True
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+
+    def serves(self, model: str) -> bool:
+        names = {model, f"{model}:latest"}
+        if self.models is not None and not names & self.models:
+            return False
+        if self.discovered is not None and not names & self.discovered:
+            return False
+        return True
+
+    def available(self, now: float) -> bool:
+        if not self.healthy:
+            return False
+        if self.open_until > now:
+            return False
+        # 遮断明けは試しの1件が終わるまで他を送らない
+        return not (self.open_until and self.probing)
+
+    def score(self) -> float:
+        if ROUTING == "latency":
+            return (self.outstanding + 1) * (self.latency or 1.0)
+        return self.outstanding + self.latency * 1e-3
+
+    def state(self, now: float) -> str:
+        if not self.healthy:
+            return "停止"
+        if self.open_until > now:
+            return "遮断中"
+        return "正常"
+
+
+class BackendPool:
+    """複数の Ollama サーバーへの振り分け・失敗の記録・遮断を行う（通信は ollama_client が行う）"""
+
+    def __init__(self, backends: List[Backend]):
+        self.backends = backends
+
+    def candidates(self, model: str, exclude: Iterable[Backend] = ()) -> List[Backend]:
+        """model を扱えて今使えるサーバーを優先順に返す"""
+        now = time.monotonic()
+        excluded = set(map(id, exclude))
+        usable = [
+            b for b in self.backends
+            if id(b) not in excluded and b.serves(model) and b.available(now)
+        ]
+        return sorted(usable, key=Backend.score)
+
+    def capacity(self, model: Optional[str] = None) -> int:
+        """（model を扱える）使用可能なサーバーの台数"""
+        if model is None:
+            now = time.monotonic()
+            return sum(1 for b in self.backends if b.available(now))
+        return len(self.candidates(model))
+
+    def acquire(self, model: str, exclude: Iterable[Backend] = ()) -> Backend:
+        exclude = list(exclude)
+        candidates = self.candidates(model, exclude)
+        if not candidates and not exclude:
+            # 全台が停止・遮断中でも、まだ試していなければ復帰の早そうなものに送ってみる
+            candidates = sorted((b for b in self.backends if b.serves(model)), key=lambda b: b.open_until)
+        if not candidates:
+            raise RuntimeError(f"モデル {model} を扱える Ollama サーバーがありません")
+        backend = candidates[0]
+        backend.outstanding += 1
+        backend.requests += 1
+        if backend.open_until:
+            backend.probing = True
+        return backend
+
+    def release(self, backend: Backend, elapsed: float, ok: Optional[bool]) -> None:
+        """ok=None（キャンセルなど）は成功・失敗のどちらにも数えない"""
+        backend.outstanding -= 1
+        backend.probing = False
+        if ok is None:
+            return
+        if ok:
+            backend.failures = 0
+            backend.open_until = 0.0
+            if backend.latency:
+                backend.latency += LATENCY_ALPHA * (elapsed - backend.latency)
+            else:
+                backend.latency = elapsed
+            return
+
+        backend.errors += 1
+        backend.failures += 1
+        if backend.failures >= CIRCUIT_THRESHOLD:
+            backend.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            print(f"Ollama サーバー {backend.base_url} を {CIRCUIT_COOLDOWN:g} 秒間使いません（連続 {backend.failures} 回失敗）")
+
+    def mark_health(self, backend: Backend, healthy: bool, models: Optional[Set[str]] = None) -> None:
+        if healthy and not backend.healthy:
+            print(f"Ollama サーバー {backend.base_url} が復帰しました")
+        elif not healthy and backend.healthy:
+            print(f"Ollama サーバー {backend.base_url} に接続できません")
+        backend.healthy = healthy
+        if healthy:
+            backend.failures = 0
+            backend.open_until = 0.0
+            if models is not None:
+                backend.discovered = models
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "url": b.base_url,
+                "state": b.state(now),
+                "outstanding": b.outstanding,
+                "latency": b.latency,
+                "requests": b.requests,
+                "errors": b.errors,
+            }
+            for b in self.backends
+        ]
+
+
+def parse_backends(spec: str) -> List[Backend]:
+    """"http://gpu0:11434=my-translator,gemma3:12b http://gpu1:11434=my-translator" の形式を読む。
+
+    "=モデル" を省略したサーバーは全モデルを扱う。区切りは空白またはセミコロン。
+    """
+    backends = []
+    for item in spec.replace(";", " ").split():
+        if "=" in item:
+            base_url, models = item.split("=", 1)
+            backends.append(Backend(base_url, {m.strip() for m in models.split(",") if m.strip()}))
+        else:
+            backends.append(Backend(item))
+    return backends
@@ -0,0 +1,73 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+class MicroBatcher:
+    """短い時間窓の中で届いた要求をグループごとにまとめ、1回の flush で処理する。
+
+    flush(group, items) は items と同じ順序の結果リストを返す。None を返すか例外を投げた場合、
+    および窓の中で1件しか集まらなかった場合は各要求に None を返すので、呼び出し側は個別処理に戻る。
+    """
+
+    def __init__(self, window: float, max_items: int,
+                 flush: Callable[[Hashable, List], Awaitable[Optional[List]]]):
+        self.window = window
+        self.max_items = max_items
+        self.flush = flush
+        self._pending: Dict[Hashable, list] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks = set()
+        # メトリクス
+        self.batches = 0
+        self.batched_items = 0
+        self.fallbacks = 0
+
+    async def submit(self, group: Hashable, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        items = self._pending.setdefault(group, [])
+        items.append((item, future))
+
+        if len(items) >= self.max_items:
+            self._start_flush(group)
+        elif len(items) == 1:
+            self._timers[group] = loop.call_later(self.window, self._start_flush, group)
+
+        return await future
+
+    def _start_flush(self, group: Hashable) -> None:
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        items = self._pending.pop(group, [])
+        if items:
+            task = asyncio.create_task(self._flush(group, items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, group: Hashable, items: list) -> None:
+        results = None
+        if len(items) > 1:
+            try:
+                results = await self.flush(group, [item for item, _ in items])
+            except Exception as e:
+                print(f"バッチ処理エラー: {e}")
+            if results is not None and len(results) == len(items):
+                self.batches += 1
+                self.batched_items += len(items)
+            else:
+                results = None
+                self.fallbacks += 1
+
+        if results is None:
+            results = [None] * len(items)
+        for (_, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "batched_items": self.batched_items,
+            "fallbacks": self.fallbacks,
+        }
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""言語判定のマイクロベンチマーク
+
+以前の on_message の判定（4つの正規表現で、最初に見つかったところで止まる）と
+utils.analyze_language（str.translate の表で置き換えて文字種ごとに数える）をメッセージ長ごとに比較する。
+旧は有無だけを見るので、日本語・韓国語を含む文では新の方が遅い（新は割合まで数えるため）。
+
+    python bench_language.py --number 2000
+"""
+import argparse
+import re
+import timeit
+
+import utils
+
+SAMPLES = {
+    "japanese": "今日はとてもいい天気ですね。カラオケに行きましょう！",
+    "korean": "오늘은 날씨가 정말 좋네요 같이 노래방 가요 ",
+    "mixed": "昨日の配信見た？ 진짜 재밌었어 https://example.com/watch?v=abc <@123456> ",
+    "english": "hello world this is a plain english sentence ",
+}
+
+
+def legacy_detect(message_content):
+    """以前の discord_bot.on_message と同じ判定"""
+    RE_HIRAGANA = re.compile(r"[぀-ゟ]")
+    RE_KATAKANA = re.compile(r"[゠-ヿ]")
+    RE_HANGUL = re.compile(r"[㄰-㆏ᄀ-ᇿꥠ-꥿가-힯ힰ-퟿]")
+    RE_CJK = re.compile(r"[一-鿿㐀-䶿豈-﫿]")
+
+    has_hiragana = bool(RE_HIRAGANA.search(message_content))
+    has_katakana = bool(RE_KATAKANA.search(message_content))
+    has_hangul = bool(RE_HANGUL.search(message_content))
+    has_cjk = bool(RE_CJK.search(message_content))
+
+    if has_hangul:
+        return "korean"
+    elif has_hiragana or has_katakana or has_cjk:
+        return "japanese"
+    return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="言語判定のマイクロベンチマーク")
+    parser.add_argument("--number", type=int, default=2000, help="1ケースあたりの実行回数")
+    parser.add_argument("--lengths", default="50,500,2000", help="カンマ区切りのメッセージ長（文字数）")
+    args = parser.parse_args()
+
+    lengths = [int(n) for n in args.lengths.split(",")]
+    print(f"{'サンプル':<10} {'文字数':>6} | {'旧 (µs)':>9} | {'新 (µs)':>9} | {'倍率':>6}")
+    print("-" * 52)
+    for name, sample in SAMPLES.items():
+        for length in lengths:
+            text = (sample * (length // len(sample) + 1))[:length]
+            legacy = timeit.timeit(lambda: legacy_detect(text), number=args.number) / args.number * 1e6
+            current = timeit.timeit(lambda: utils.analyze_language(text), number=args.number) / args.number * 1e6
+            print(f"{name:<10} {length:>6} | {legacy:>9.2f} | {current:>9.2f} | {legacy / current:>5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
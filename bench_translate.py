@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""翻訳・Q&A 経路のオフラインベンチマーク
+
+mock_ollama の代替サーバーに対して ollama.translate_text / ollama_thinking.think_text /
+discord_bot.on_message を実行し、スループット・レイテンシ・最初のトークンまでの時間・
+キャッシュヒット率を JSON で出力する。コミット間の比較には --compare を使う。
+
+    python bench_translate.py --concurrency 8 --output before.json
+    python bench_translate.py --concurrency 8 --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+# discord_bot の import 時に参照されるので先に設定しておく
+os.environ.setdefault("DISCORD_CHANNEL_ID", "1")
+# 永続キャッシュを汚さないようにメモリのみで計測する
+os.environ["TRANSLATION_CACHE_DB"] = ""
+# 同じ送信者から大量に送るので、レート制限は無効にする
+for _name in ("RATE_LIMIT_TRANSLATE_USER", "RATE_LIMIT_TRANSLATE_CHANNEL", "RATE_LIMIT_THINK_USER", "RATE_LIMIT_THINK_CHANNEL"):
+    os.environ[_name] = "0"
+# Bot の処理時間を測るので、Discord 向けの送信レートの制御も無効にする
+os.environ["OUTBOUND_RATE"] = "0"
+
+import ollama
+import ollama_client
+import ollama_thinking
+import utils
+from mock_ollama import MockOllama, start_server
+from scheduler import scheduler
+from translation_cache import cache
+
+# 既定のコーパス（日本語・韓国語のチャットを想定）
+DEFAULT_CORPUS = [
+    "おはよう",
+    "ありがとう",
+    "今日は何時に集まる？",
+    "昨日のライブ最高だったね！また行きたい",
+    "ちょっと遅れるかも、先に始めてて",
+    "안녕하세요",
+    "ㅋㅋㅋ 진짜 웃기다",
+    "고마워요",
+    "오늘 저녁에 게임 할래?",
+    "내일 시간 있으면 같이 밥 먹어요",
+]
+DEFAULT_QUESTIONS = [
+    "?東京でおすすめの観光地は？",
+    "?Pythonのasyncioを簡単に説明して",
+]
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _summarize(latencies, ttfts, elapsed):
+    summary = {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": _percentile(latencies, 50),
+        "p95": _percentile(latencies, 95),
+        "p99": _percentile(latencies, 99),
+    }
+    if ttfts:
+        summary["ttft_p50"] = _percentile(ttfts, 50)
+        summary["ttft_p95"] = _percentile(ttfts, 95)
+    return summary
+
+
+def _direction(text):
+    if utils.analyze_language(text).language == "korean":
+        return "ko", "ja"
+    return "ja", "ko"
+
+
+async def _run_concurrently(items, concurrency, worker):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, ttfts = [], []
+
+    async def run(item):
+        async with semaphore:
+            start = time.monotonic()
+            ttft = await worker(item, start)
+            latencies.append(time.monotonic() - start)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    start = time.monotonic()
+    await asyncio.gather(*(run(item) for item in items))
+    return _summarize(latencies, ttfts, time.monotonic() - start)
+
+
+async def bench_translate(corpus, concurrency):
+    async def worker(text, start):
+        source_lang, target_lang = _direction(text)
+        await ollama.translate_text(text, source_lang, target_lang)
+        return None
+    return await _run_concurrently(corpus, concurrency, worker)
+
+
+async def bench_translate_stream(corpus, concurrency):
+    async def worker(text, start):
+        source_lang, target_lang = _direction(text)
+        ttft = None
+        async for _ in ollama.translate_text_stream(text, source_lang, target_lang):
+            if ttft is None:
+                ttft = time.monotonic() - start
+        return ttft
+    return await _run_concurrently(corpus, concurrency, worker)
+
+
+async def bench_think(questions, concurrency):
+    async def worker(question, start):
+        ttft = None
+        async for _ in ollama_thinking.think_text_stream(question.lstrip("?？")):
+            if ttft is None:
+                ttft = time.monotonic() - start
+        return ttft
+    return await _run_concurrently(questions, concurrency, worker)
+
+
+def _has_text(content):
+    """プレースホルダー（見出しと⌛だけ）ではなく本文を含むか"""
+    if not content:
+        return False
+    lines = [ln for ln in content.replace("⌛", "").splitlines() if ln.strip()]
+    return any(not ln.startswith("翻訳結果") for ln in lines)
+
+
+class _FakeMessage:
+    """on_message に渡すための最小限のメッセージ（本文が最初に表示された時刻を記録する）"""
+
+    def __init__(self, content, channel):
+        self.content = content
+        self.channel = channel
+        self.author = SimpleNamespace(bot=False, id=1, voice=None)
+        self.guild = SimpleNamespace(id=1, voice_client=None)
+        self.id = id(self)
+
+    async def edit(self, content=None, **kwargs):
+        if _has_text(content):
+            self.channel.mark_text()
+        self.content = content
+
+
+class _FakeChannel:
+    """メッセージごとに作る、同じIDのチャンネル（送信キューは予約したオブジェクトに送るので、
+    本文が最初に表示された時刻がメッセージごとに記録される）"""
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.first_text_at = None
+
+    def mark_text(self):
+        if self.first_text_at is None:
+            self.first_text_at = time.monotonic()
+
+    async def send(self, content=None, **kwargs):
+        if _has_text(content):
+            self.mark_text()
+        return _FakeMessage(content, self)
+
+
+async def bench_on_message(corpus, concurrency):
+    import discord_bot
+
+    async def worker(text, start):
+        channel = _FakeChannel(discord_bot.CHANNEL_ID)
+        await discord_bot.on_message(_FakeMessage(text, channel))
+        if channel.first_text_at is not None:
+            return channel.first_text_at - start
+        return None
+    return await _run_concurrently(corpus, concurrency, worker)
+
+
+def _compare(current, baseline):
+    """baseline からの変化率を表示する"""
+    print("\n=== 比較 (現在 vs ベースライン) ===")
+    for stage, metrics in current["results"].items():
+        base = baseline.get("results", {}).get(stage)
+        if not base:
+            continue
+        for name, value in metrics.items():
+            if name == "count" or name not in base or not base[name]:
+                continue
+            change = (value - base[name]) / base[name] * 100
+            print(f"{stage:<18} {name:<10} {base[name]:>10.4f} -> {value:>10.4f} ({change:+.1f}%)")
+
+
+async def run(args):
+    corpus = DEFAULT_CORPUS
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    corpus = corpus * args.repeat
+
+    runner = None
+    if args.url:
+        ollama_client.configure(args.url)
+    else:
+        mock = MockOllama(args.token_latency, args.prompt_latency, 0.0, args.answer_tokens, args.parallel)
+        runner, mock_url = await start_server(mock)
+        ollama_client.configure(mock_url)
+
+    stages = args.stages.split(",")
+    results = {}
+    try:
+        for stage in stages:
+            before = cache.stats()
+            if stage == "translate":
+                results[stage] = await bench_translate(corpus, args.concurrency)
+            elif stage == "translate_stream":
+                results[stage] = await bench_translate_stream(corpus, args.concurrency)
+            elif stage == "think":
+                results[stage] = await bench_think(DEFAULT_QUESTIONS * args.repeat, args.concurrency)
+            elif stage == "on_message":
+                results[stage] = await bench_on_message(corpus, args.concurrency)
+            else:
+                print(f"不明なステージ: {stage}", file=sys.stderr)
+                continue
+            after = cache.stats()
+            lookups = (after["hits"] - before["hits"]) + (after["misses"] - before["misses"])
+            results[stage]["cache_hit_rate"] = (after["hits"] - before["hits"]) / lookups if lookups else 0.0
+            if not args.keep_cache:
+                cache.clear()
+    finally:
+        await ollama_client.close_session()
+        if runner is not None:
+            await runner.cleanup()
+
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "repeat": args.repeat,
+            "corpus_size": len(corpus),
+            "token_latency": args.token_latency,
+            "prompt_latency": args.prompt_latency,
+            "parallel": args.parallel,
+            "url": args.url or "mock",
+        },
+        "results": results,
+        "scheduler": scheduler.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="翻訳・Q&A 経路のオフラインベンチマーク")
+    parser.add_argument("--stages", default="translate,translate_stream,think,on_message",
+                        help="実行するステージ（カンマ区切り）")
+    parser.add_argument("--corpus", help="1行1メッセージのコーパスファイル")
+    parser.add_argument("--repeat", type=int, default=3, help="コーパスの繰り返し回数")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--prompt-latency", type=float, default=0.02)
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--parallel", type=int, default=2, help="代替サーバーの同時生成数")
+    parser.add_argument("--url", help="代替サーバーではなく指定の /api/generate を使う")
+    parser.add_argument("--keep-cache", action="store_true", help="ステージ間で翻訳キャッシュを残す")
+    parser.add_argument("--output", help="結果の JSON を保存するファイル")
+    parser.add_argument("--compare", help="比較対象の結果 JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            _compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,162 @@
+import argparse
+import csv
+import json
+import os
+import statistics
 import subprocess
 import time
-import os
-import re
-import sys
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
 # ================= 設定エリア =================
-# テストしたいモデル名
+# テストしたいモデル名（--models で上書き可）
 # 速度比較用（軽量）: gemma3:4b, llama3
 # 本気テスト用（重量）: llama3:8b-instruct-q8_0, mistral-nemo
-MODEL_NAME = "gemma3:27b" 
+MODELS = ["gemma3:27b"]
+
+# プロンプト（--prompts-file で上書き可）
+PROMPTS = {
+    "relativity": "Explain the theory of relativity in simple terms for a 5-year-old in about 100 words.",
+    "translate_ja_ko": "韓国語に翻訳: 昨日のライブ最高だったね！また行きたい",
+    "translate_ko_ja": "日本語に翻訳: 내일 시간 있으면 같이 밥 먹어요",
+}
 
-# プロンプト (少し長めに生成させる)
-PROMPT = "Explain the theory of relativity in simple terms for a 5-year-old in about 100 words."
+# GPU構成（名前, CUDA_VISIBLE_DEVICES）。--configs で上書き可、--url 指定時は使わない
+CONFIGS = [
+    ("GTX 1660 Ti (Single)", "0"),
+    ("GTX 1070 (Single)",    "1"),
+    ("Dual GPU (Both)",      "0,1"),
+]
+
+# 同時リクエスト数と試行回数
+CONCURRENCY = [1]
+TRIALS = 3
+
+# ollama serve を起動するアドレス
+HOST = "127.0.0.1:11434"
 # ==============================================
 
-def run_command(command, env=None):
-    """コマンドを実行し、リアルタイムで表示しつつ出力を返す"""
-    try:
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            env=env
-        )
-        
-        full_output = ""
-        while True:
-            line = process.stdout.readline()
-            if not line and process.poll() is not None:
-                break
-            if line:
-                print(line.strip()) # 進行状況を表示
-                full_output += line
-        
-        return full_output
-    except Exception as e:
-        return str(e)
-
-def parse_metrics(output):
-    """ログから生成速度と読解速度を抽出する"""
-    metrics = {
-        "eval_rate": 0.0,       # 生成速度 (重要: チャットの滑らかさ)
-        "prompt_eval_rate": 0.0 # 読解速度 (入力の処理)
+# 集計する指標（/api/generate のレスポンスから算出）
+METRICS = ["latency", "eval_rate", "prompt_eval_rate", "load_duration", "throughput"]
+
+
+def request_json(url, payload=None, timeout=600):
+    """JSON を POST（payload が None なら GET）してレスポンスを返す"""
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def wait_until_ready(base_url, timeout=60.0):
+    """固定の待ち時間ではなく、/api/tags が応答するまでポーリングする"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            request_json(f"{base_url}/api/tags", timeout=2)
+            return True
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.2)
+    return False
+
+
+def generate(base_url, model, prompt, keep_alive=None):
+    payload = {"model": model, "prompt": prompt, "stream": False}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    start = time.monotonic()
+    data = request_json(f"{base_url}/api/generate", payload)
+    data["latency"] = time.monotonic() - start
+    return data
+
+
+def unload(base_url, model):
+    """keep_alive=0 の空リクエストでモデルをメモリから外す（コールド計測用）"""
+    request_json(f"{base_url}/api/generate", {"model": model, "keep_alive": 0})
+
+
+def parse_metrics(data):
+    """/api/generate のレスポンスから速度を計算する（duration はナノ秒）"""
+    def rate(count, duration):
+        return count / (duration / 1e9) if duration else 0.0
+
+    return {
+        "latency": data["latency"],
+        "eval_rate": rate(data.get("eval_count", 0), data.get("eval_duration", 0)),
+        "prompt_eval_rate": rate(data.get("prompt_eval_count", 0), data.get("prompt_eval_duration", 0)),
+        "load_duration": data.get("load_duration", 0) / 1e9,
+        "eval_count": data.get("eval_count", 0),
     }
-    
-    # 正規表現で数値を抽出
-    # "prompt eval rate" を先に探す
-    prompt_match = re.search(r'prompt eval rate:\s+([\d\.]+)\s+tokens/s', output)
-    if prompt_match:
-        metrics["prompt_eval_rate"] = float(prompt_match.group(1))
-
-    # "eval rate" (promptがつかない純粋なもの) を探す
-    # 行頭、または改行直後の eval rate を狙う
-    eval_match = re.search(r'(?<!prompt )eval rate:\s+([\d\.]+)\s+tokens/s', output)
-    if eval_match:
-        metrics["eval_rate"] = float(eval_match.group(1))
-        
-    return metrics
-
-def benchmark(config_name, gpu_ids):
+
+
+def run_trial(base_url, model, prompt, concurrency):
+    """concurrency 件を同時に投げ、平均の指標と全体の生成スループットを返す"""
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        responses = list(pool.map(lambda _: generate(base_url, model, prompt), range(concurrency)))
+    elapsed = time.monotonic() - start
+
+    metrics = [parse_metrics(data) for data in responses]
+    trial = {name: statistics.mean(m[name] for m in metrics) for name in METRICS if name != "throughput"}
+    trial["throughput"] = sum(m["eval_count"] for m in metrics) / elapsed if elapsed else 0.0
+    return trial
+
+
+def summarize(trials):
+    summary = {}
+    for name in METRICS:
+        values = [t[name] for t in trials]
+        summary[f"{name}_mean"] = statistics.mean(values)
+        summary[f"{name}_stdev"] = statistics.stdev(values) if len(values) > 1 else 0.0
+        summary[f"{name}_min"] = min(values)
+        summary[f"{name}_max"] = max(values)
+    return summary
+
+
+def run_matrix(config_name, base_url, models, prompts, concurrencies, trials, cold):
+    rows = []
+    for model in models:
+        for prompt_name, prompt in prompts.items():
+            if cold:
+                # コールド: 毎回モデルを外してから1件だけ投げる
+                cold_trials = []
+                for _ in range(trials):
+                    unload(base_url, model)
+                    cold_trials.append(run_trial(base_url, model, prompt, 1))
+                rows.append(_row(config_name, model, prompt_name, 1, "cold", cold_trials))
+
+            # ウォーム: 1回読み込ませてから計測
+            generate(base_url, model, prompt)
+            for concurrency in concurrencies:
+                warm_trials = [run_trial(base_url, model, prompt, concurrency) for _ in range(trials)]
+                rows.append(_row(config_name, model, prompt_name, concurrency, "warm", warm_trials))
+                print(f"{config_name} | {model} | {prompt_name} | x{concurrency} -> "
+                      f"生成: {rows[-1]['eval_rate_mean']:.2f} t/s, "
+                      f"読込: {rows[-1]['prompt_eval_rate_mean']:.2f} t/s, "
+                      f"遅延: {rows[-1]['latency_mean']:.2f} s")
+    return rows
+
+
+def _row(config_name, model, prompt_name, concurrency, phase, trials):
+    return {
+        "config": config_name,
+        "model": model,
+        "prompt": prompt_name,
+        "concurrency": concurrency,
+        "phase": phase,
+        "trials": len(trials),
+        **summarize(trials),
+    }
+
+
+def benchmark(config_name, gpu_ids, args):
+    """GPU構成ごとに ollama serve を起動して計測する"""
     print(f"\n--- {config_name} のテストを開始 ---")
     current_env = os.environ.copy()
     current_env["CUDA_VISIBLE_DEVICES"] = gpu_ids
-    
+    current_env["OLLAMA_HOST"] = HOST
+
     # サーバー起動
     print(f"Ollamaサーバーを起動中 (GPU: {gpu_ids})...")
     server_process = subprocess.Popen(
@@ -73,50 +165,101 @@ def benchmark(config_name, gpu_ids):
         stderr=subprocess.DEVNULL,
         env=current_env
     )
-    time.sleep(5) # 起動待ち
-    
+    base_url = f"http://{HOST}"
+
     try:
-        print(f"モデル '{MODEL_NAME}' で推論を実行中...")
-        cmd = f'ollama run {MODEL_NAME} --verbose "{PROMPT}"'
-        output = run_command(cmd, env=current_env)
-        
-        metrics = parse_metrics(output)
-        print(f"計測結果 -> 生成: {metrics['eval_rate']} t/s, 読込: {metrics['prompt_eval_rate']} t/s")
-        return metrics
-        
+        if not wait_until_ready(base_url):
+            print("Ollamaサーバーが起動しませんでした。")
+            return []
+        return run_matrix(config_name, base_url, args.models, args.prompts,
+                          args.concurrency, args.trials, args.cold)
     finally:
         # サーバー停止
         server_process.terminate()
         server_process.wait()
-        time.sleep(2)
+
+
+def write_results(rows, prefix):
+    with open(f"{prefix}.json", "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    if rows:
+        with open(f"{prefix}.csv", "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f"結果を {prefix}.json / {prefix}.csv に保存しました。")
+
+
+def parse_configs(parser, text):
+    """「名前=GPU番号;...」を [(名前, CUDA_VISIBLE_DEVICES), ...] にする"""
+    configs = []
+    for item in text.split(";"):
+        if not item.strip():
+            continue
+        name, sep, gpu_id = item.partition("=")
+        if not sep or not name.strip() or not gpu_id.strip():
+            parser.error(f"--configs の形式が不正です: {item!r}（名前=GPU番号）")
+        configs.append((name.strip(), gpu_id.strip()))
+    if not configs:
+        parser.error("--configs に構成がありません")
+    return configs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ollama ベンチマーク（モデル × プロンプト × 同時数 × 構成）")
+    parser.add_argument("--models", default=",".join(MODELS), help="カンマ区切りのモデル名")
+    parser.add_argument("--prompts-file", help="JSON ファイル（{名前: プロンプト}）")
+    parser.add_argument("--concurrency", default=",".join(map(str, CONCURRENCY)), help="カンマ区切りの同時数")
+    parser.add_argument("--trials", type=int, default=TRIALS)
+    parser.add_argument("--cold", action="store_true", help="モデルを外した状態からの計測も行う")
+    parser.add_argument("--configs", default=";".join(f"{name}={gpu_id}" for name, gpu_id in CONFIGS),
+                        help="セミコロン区切りの「名前=CUDA_VISIBLE_DEVICES」（例: single=0;dual=0,1）")
+    parser.add_argument("--url", help="既存のエンドポイントを使う（例: http://localhost:11434）。ollama serve は起動しない")
+    parser.add_argument("--output", default="bench_results", help="結果ファイルの接頭辞")
+    args = parser.parse_args()
+
+    args.models = [m for m in args.models.split(",") if m]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    args.configs = parse_configs(parser, args.configs)
+    args.prompts = PROMPTS
+    if args.prompts_file:
+        with open(args.prompts_file, encoding="utf-8") as f:
+            args.prompts = json.load(f)
+    return args
+
 
 def main():
-    print("=== Ollama マルチGPU ベンチマーク (修正版) ===")
-    print(f"Target Model: {MODEL_NAME}")
-    print("※事前に 'sudo systemctl stop ollama' を実行済みであることを確認してください。")
-    
-    results = []
-    configs = [
-        ("GTX 1660 Ti (Single)", "0"),
-        ("GTX 1070 (Single)",    "1"),
-        ("Dual GPU (Both)",      "0,1")
-    ]
-
-    for name, gpu_id in configs:
-        metrics = benchmark(name, gpu_id)
-        results.append((name, metrics))
+    args = parse_args()
+    print("=== Ollama ベンチマーク ===")
+    print(f"Target Models: {', '.join(args.models)}")
+
+    rows = []
+    if args.url:
+        base_url = args.url.rstrip("/").removesuffix("/api/generate")
+        if not wait_until_ready(base_url):
+            print(f"{base_url} に接続できません。")
+            return
+        rows = run_matrix(base_url, base_url, args.models, args.prompts,
+                          args.concurrency, args.trials, args.cold)
+    else:
+        print("※事前に 'sudo systemctl stop ollama' を実行済みであることを確認してください。")
+        for name, gpu_id in args.configs:
+            rows.extend(benchmark(name, gpu_id, args))
 
     # === 結果発表 ===
-    print("\n" + "="*65)
-    print(f"ベンチマーク結果 (Model: {MODEL_NAME})")
-    print("="*65)
-    print(f"{'構成':<22} | {'生成速度 (Tokens/s)':<20} | {'読解速度 (Tokens/s)':<20}")
-    print("-" * 65)
-    for name, m in results:
+    print("\n" + "=" * 100)
+    print(f"{'構成':<22} | {'モデル':<16} | {'プロンプト':<16} | {'同時数':>4} | {'状態':<4} | "
+          f"{'生成速度 (t/s)':>14} | {'遅延 (s)':>9}")
+    print("-" * 100)
+    for r in rows:
         # 生成速度（eval_rate）がチャットの速さです
-        print(f"{name:<22} | {m['eval_rate']:<20.2f} | {m['prompt_eval_rate']:<20.2f}")
-    print("="*65)
+        print(f"{r['config']:<22} | {r['model']:<16} | {r['prompt']:<16} | {r['concurrency']:>4} | {r['phase']:<4} | "
+              f"{r['eval_rate_mean']:>8.2f}±{r['eval_rate_stdev']:<5.2f} | {r['latency_mean']:>9.2f}")
+    print("=" * 100)
     print("※ 生成速度が大きいほどチャットが快適です。")
 
+    write_results(rows, args.output)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
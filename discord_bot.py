@@ -1,32 +1,211 @@
 #!/usr/bin/env python3
-import os
+import asyncio
+import importlib
+import time
 import discord
-from dotenv import load_dotenv
-import re
+from settings import settings
 
 import ollama
+import ollama_client
 import ollama_thinking  
-from vc_music import (
-    play_url_from_message, 
-    skip_song, 
-    pause_song, 
-    resume_song, 
-    show_queue, 
-    clear_queue, 
-    disconnect_from_message
-)
-
-load_dotenv()
-TOKEN = os.getenv("DISCORD_TOKEN")
-CHANNEL_ID = int(os.getenv("DISCORD_CHANNEL_ID", "0"))
+import prefilter
+import startup
+import utils
+from qa_sessions import sessions as qa_sessions
+from rate_limiter import limiter
+from metrics import metrics
+from model_manager import manager as model_manager
+from outbound import MESSAGE_LIMIT, outbox
+from reply_tracker import replies
+
+TOKEN = settings.get("DISCORD_TOKEN")
+CHANNEL_ID = settings.get_int("DISCORD_CHANNEL_ID", 0)
+# ストリーミング返信（生成途中のテキストをメッセージ編集で逐次表示）
+STREAM_REPLIES = settings.get_bool("STREAM_REPLIES", True)
+# メッセージ編集の最小間隔（秒）。Discord の編集レート制限（5回/5秒程度）を超えないようにする
+STREAM_EDIT_INTERVAL = settings.get_float("STREAM_EDIT_INTERVAL", 1.2)
+# 判定した言語 -> (翻訳元, 翻訳先, 返信の見出し)
+DIRECTIONS = {
+    "korean": ("ko", "ja", "翻訳結果 (韓国語→日本語):\n"),
+    "japanese": ("ja", "ko", "翻訳結果 (日本語→韓国語):\n"),
+}
 
 intents = discord.Intents.default()
 intents.message_content = True
 client = discord.Client(intents=intents)
 
+_music_lock = asyncio.Lock()
+# import が終わった vc_music（sys.modules には import の途中から入っているので、そちらは見ない）
+_music_module = None
+
+async def music():
+    """音楽機能（vc_music と yt-dlp）は重いので、最初の音楽コマンドのときに読み込む"""
+    global _music_module
+    if _music_module is not None:
+        return _music_module
+    async with _music_lock:
+        if _music_module is None:
+            start = time.perf_counter()
+            # import 中もイベントループを止めない
+            _music_module = await asyncio.to_thread(importlib.import_module, "vc_music")
+            startup.record("vc_music（初回の音楽コマンド）", time.perf_counter() - start)
+        return _music_module
+
+async def send_streaming(channel, header, chunks, finalize=None):
+    """プレースホルダーを送信し、生成途中のテキストで一定間隔ごとに編集する。
+
+    chunks はそれまでの出力全体を返す非同期イテレータ。最後に finalize で整形した結果で確定させる。
+    送ったメッセージと確定した本文を返す。
+    """
+    start = time.monotonic()
+    message = await outbox.send(channel, f"{header}⌛")
+    text = ""
+    # 最初のトークンは待たずに表示する
+    last_edit = 0.0
+
+    async for text in chunks:
+        now = time.monotonic()
+        if not last_edit and text.strip():
+            metrics.record_stage("first_token", now - start)
+        if text.strip() and now - last_edit >= STREAM_EDIT_INTERVAL:
+            # 途中経過は送信を待たない（送る前に次の編集が来たら古い方は送らない）
+            outbox.edit(message, f"{header}{text} ⌛", progress=True)
+            last_edit = now
+
+    final = finalize(text) if finalize else text
+    if not final.strip():
+        final = "（応答がありませんでした）"
+    # 2000文字を超える分は続けて別のメッセージで送られる
+    with metrics.stage("send"):
+        await outbox.edit(message, f"{header}{final}")
+    return message, final
+
+async def allow_request(message, kind, text):
+    """レート制限を確認する。超えていれば1回目だけ返信し、以降はリアクションだけで知らせる"""
+    decision = limiter.check(kind, message.author.id, message.channel.id, text)
+    if decision.allowed:
+        return True
+
+    try:
+        if decision.notify:
+            await message.reply(
+                f"⏳ リクエストが多すぎます。{decision.retry_after:.0f}秒ほど待ってから送ってください。",
+                mention_author=False,
+            )
+        else:
+            await message.add_reaction("⏳")
+    except discord.HTTPException as e:
+        print(f"レート制限の通知エラー: {e}")
+    return False
+
+async def send_translation(message, text, source_lang, target_lang, header):
+    """翻訳して送信する（STREAM_REPLIES ならストリーミング。まとめ翻訳が有効なときは一括で送る）"""
+    channel = message.channel
+    # 定番フレーズは辞書から返す（モデルを使わないのでレート制限の対象外）
+    phrase = prefilter.lookup_phrase(text, source_lang, target_lang)
+    if phrase:
+        prefilter.stats["phrase_hits"] += 1
+        body = f"{header}{phrase}"
+        reply = await outbox.send(channel, body, group="translation")
+        # 混雑時に他の訳と1通にまとめて送った返信は書き換えられない
+        if reply.content == body:
+            track_reply(message, reply, body, source_lang, target_lang, {text: phrase})
+        return
+
+    if not await allow_request(message, "translate", text):
+        return
+
+    user = message.author.id
+    # 複数行・長文は塊ごとに並列で翻訳するので、ストリーミングせずにまとめて送る。
+    # 送信が混み合っているときも、編集を重ねずに訳が出てから1通で送る（混雑中の短い訳は1通にまとめられる）
+    chunks = ollama.split_chunks(text)
+    if STREAM_REPLIES and not ollama.BATCH_WINDOW and len(chunks) <= 1 and not outbox.busy(channel):
+        stream = ollama.translate_text_stream(text, source_lang, target_lang, user)
+        reply, translated_text = await send_streaming(channel, header, stream, ollama._post_process_output)
+        track_reply(message, reply, f"{header}{translated_text}", source_lang, target_lang,
+                    dict(zip(chunks, [translated_text])))
+    else:
+        if len(chunks) > 1:
+            # 編集されたときに変わっていない塊の訳を使い回せるよう、塊ごとの訳を残す
+            results = await ollama.translate_chunks(chunks, source_lang, target_lang, user)
+            translated_text = ollama.CHUNK_SEPARATOR.join(results)
+        else:
+            translated_text = await ollama.translate_text(text, source_lang, target_lang, user)
+            results = [translated_text]
+        body = f"{header}{translated_text}"
+        reply = await outbox.send(channel, body, group="translation")
+        if reply.content == body:
+            track_reply(message, reply, body, source_lang, target_lang, dict(zip(chunks, results)))
+
+def track_reply(message, reply, body, source_lang, target_lang, segments):
+    """元のメッセージが編集されたときに書き換えられるよう、返信と塊ごとの訳を覚えておく"""
+    # 分けて送った長い返信は書き換えられない
+    if reply is None or len(body) > MESSAGE_LIMIT:
+        return
+    replies.track(message.id, reply.id, source_lang, target_lang, segments)
+
+async def retranslate(message):
+    """編集後の本文のうち、前回から変わった文だけを翻訳し直して返信を書き換える。
+
+    変わっていない塊は前回の訳をそのまま使い、変わった塊は文に分けて、
+    前回の編集で訳した文・定番フレーズ以外をまとめて1回の生成で翻訳する。
+    """
+    entry = replies.get(message.id)
+    if entry is None:
+        return
+    with metrics.request("edit"):
+        with metrics.stage("detect"):
+            cleaned = prefilter.clean_text(message.content)
+            trivial = prefilter.is_trivial(cleaned)
+            language = None if trivial else utils.analyze_language(cleaned).language
+        # 翻訳しない内容に書き換えられたときは返信をそのままにする
+        if language not in DIRECTIONS:
+            return
+        source_lang, target_lang, header = DIRECTIONS[language]
+
+        with metrics.stage("split"):
+            chunks = ollama.split_chunks(cleaned)
+        translated, changed = replies.plan(entry, chunks, ollama.split_sentences, source_lang, target_lang)
+        pending = []
+        for sentence in changed:
+            # 笑い・記号だけの文は訳さず、定番フレーズは辞書から
+            if prefilter.is_trivial(sentence):
+                translated[sentence] = ""
+                continue
+            phrase = prefilter.lookup_phrase(sentence, source_lang, target_lang)
+            if phrase:
+                prefilter.stats["phrase_hits"] += 1
+                translated[sentence] = phrase
+            else:
+                pending.append(sentence)
+        if pending:
+            if not await allow_request(message, "translate", "".join(pending)):
+                return
+            results = await ollama.translate_sentences(pending, source_lang, target_lang, message.author.id)
+            translated.update(zip(pending, results))
+
+        results = []
+        for chunk in chunks:
+            if chunk not in translated:
+                pieces = [translated[sentence] for sentence in ollama.split_sentences(chunk)]
+                translated[chunk] = ollama.CHUNK_SEPARATOR.join(piece for piece in pieces if piece)
+            results.append(translated[chunk])
+        body = f"{header}{ollama.CHUNK_SEPARATOR.join(result for result in results if result)}"
+        reply = message.channel.get_partial_message(entry.reply_id)
+        with metrics.stage("send"):
+            await outbox.edit(reply, body)
+        if len(body) > MESSAGE_LIMIT:
+            # 続きが別のメッセージになったので、以降の編集には追従しない
+            replies.forget(message.id)
+        else:
+            # 次の編集に備えて、塊と文の両方の訳を残す
+            replies.track(message.id, entry.reply_id, source_lang, target_lang, translated)
+
 @client.event
 async def on_ready():
     print(f"Logged in as {client.user}")
+    if startup.mark_ready():
+        print(startup.report())
     if CHANNEL_ID:
         channel = client.get_channel(CHANNEL_ID)
         if not channel:
@@ -35,12 +214,29 @@ async def on_ready():
             except Exception as e:
                 print(f"Failed to fetch channel {CHANNEL_ID}: {e}")
         # if channel:
-            await channel.send("起動しました！")
+            await outbox.send(channel, "起動しました！")
         else:
             print(f"Channel {CHANNEL_ID} not found. Ensure the bot is in the server and has access.")
     else:
         print("CHANNEL_ID not set")
 
+    # 使える Ollama サーバーを確認してから、翻訳・Q&A のモデルを先に読み込んでおく（初回のコールドスタートを避ける）
+    await ollama_client.start_health_checks()
+    # イベントループの遅延の計測と、メトリクスの HTTP サーバー
+    await metrics.start()
+    await model_manager.start([ollama.MODEL_NAME, ollama_thinking.MODEL_NAME])
+
+def _is_admin(message):
+    permissions = getattr(message.author, "guild_permissions", None)
+    return permissions is not None and permissions.manage_guild
+
+def _request_kind(content):
+    if content.startswith(("!", "！")):
+        return "command"
+    if content.startswith(("?", "？")):
+        return "think"
+    return "translate"
+
 @client.event
 async def on_message(message):
     # 自分自身を含む、すべてのBOTからのメッセージを無視する
@@ -50,35 +246,86 @@ async def on_message(message):
     elif message.channel.id != CHANNEL_ID:
         return
 
+    # 処理全体と段階ごとの時間を記録する
+    with metrics.request(_request_kind(message.content)):
+        await handle_message(message)
+
+@client.event
+async def on_message_edit(before, after):
+    if after.author.bot or after.channel.id != CHANNEL_ID:
+        return
+    # リンクのプレビューが付いただけの編集や、翻訳していないメッセージの編集は無視する
+    if before.content == after.content or replies.get(after.id) is None:
+        return
+    # 続けて編集されたときは、最後の編集の後にまとめて1回だけ翻訳し直す
+    replies.schedule(after.id, lambda: retranslate(after))
+
+@client.event
+async def on_message_delete(message):
+    replies.forget(message.id)
+
+async def handle_message(message):
     # 音楽コマンド
-    elif message.content.startswith(("!p ", "！ｐ ")):
-        await play_url_from_message(message, message.content[3:].strip())
+    if message.content.startswith(("!p ", "！ｐ ")):
+        metrics.set_kind("music")
+        await (await music()).play_url_from_message(message, message.content[3:].strip())
         return
     
     elif message.content.startswith(("!skip", "！skip")):
-        await skip_song(message)
+        await (await music()).skip_song(message)
         return
     
     elif message.content.startswith(("!pause", "！pause")):
-        await pause_song(message)
+        await (await music()).pause_song(message)
         return
     
     elif message.content.startswith(("!resume", "！resume")):
-        await resume_song(message)
+        await (await music()).resume_song(message)
         return
     
     elif message.content.startswith(("!queue", "！queue")):
-        await show_queue(message)
+        await (await music()).show_queue(message)
         return
     
     elif message.content.startswith(("!clear", "！clear")):
-        await clear_queue(message)
+        await (await music()).clear_queue(message)
         return
     
     elif message.content.startswith(("!stop", "！stop", "!disconnect", "！disconnect")):
-        await disconnect_from_message(message)
+        await (await music()).disconnect_from_message(message)
         return
     
+    elif message.content.startswith(("!reset", "！reset")):
+        if qa_sessions.reset((message.channel.id, message.author.id)):
+            await outbox.send(message.channel, "🧹 AIとの会話をリセットしました。")
+        else:
+            await outbox.send(message.channel, "リセットする会話はありません。")
+        return
+
+    elif message.content.startswith(("!musicstats", "！musicstats")):
+        await (await music()).show_music_stats(message)
+        return
+
+    elif message.content.startswith(("!startup", "！startup")):
+        await outbox.send(message.channel, startup.report())
+        return
+
+    elif message.content.startswith(("!metrics", "！metrics")):
+        # 処理時間の内訳はサーバーの管理者だけが見られる
+        if not _is_admin(message):
+            await outbox.send(message.channel, "このコマンドはサーバーの管理者のみ使えます。")
+            return
+        await outbox.send(message.channel, metrics.summary())
+        return
+
+    elif message.content.startswith(("!models", "！models")):
+        # Ollama サーバーのアドレスや状態を含むので、サーバーの管理者だけが見られる
+        if not _is_admin(message):
+            await outbox.send(message.channel, "このコマンドはサーバーの管理者のみ使えます。")
+            return
+        await outbox.send(message.channel, await model_manager.status())
+        return
+
     elif message.content.startswith(("!help", "！help", "!h", "！h")):
         help_text = """
 📚 **Bot コマンド一覧**
@@ -98,13 +345,18 @@ async def on_message(message):
 • 韓国語 → 日本語
 
 **🤔 AI機能:**
-`?[質問]` - AI (Gemma 12B) に質問
+`?[質問]` - AI (Gemma 12B) に質問（続けて質問すると前の会話の続きとして答えます）
+`!reset` - AIとの会話をリセット
 
 **ℹ️ その他:**
+`!models` - モデルの読み込み状態を表示（管理者のみ）
+`!musicstats` - 音楽再生の統計を表示
+`!startup` - 起動時間の内訳を表示
+`!metrics` - 処理時間の内訳を表示（管理者のみ）
 `!help` - このヘルプを表示
 
 """
-        await message.channel.send(help_text)
+        await outbox.send(message.channel, help_text)
         return
 
     # message_content を最初に初期化
@@ -116,28 +368,32 @@ async def on_message(message):
     elif message.content.startswith(("?", "？")):
         # 1文字目を削除
         trimmed_content = message.content[1:]
-        think_text = ollama_thinking.think_text(trimmed_content)
-        await message.channel.send(f"{think_text}")
+        if not await allow_request(message, "think", trimmed_content):
+            return
+        # 同じチャンネルの同じ人の質問は、前回までの会話の続きとして答える
+        session = (message.channel.id, message.author.id)
+        if STREAM_REPLIES:
+            stream = ollama_thinking.think_text_stream(trimmed_content, message.author.id, session)
+            await send_streaming(message.channel, "", stream)
+        else:
+            think_text = await ollama_thinking.think_text(trimmed_content, message.author.id, session)
+            await outbox.send(message.channel, f"{think_text}")
 
     # 翻訳処理（日本語/韓国語のみ想定）
     elif message_content.strip():
-        RE_HIRAGANA = re.compile(r"[\u3040-\u309F]")
-        RE_KATAKANA = re.compile(r"[\u30A0-\u30FF]")
-        RE_HANGUL = re.compile(r"[\u3130-\u318F\u1100-\u11FF\uA960-\uA97F\uAC00-\uD7AF\uD7B0-\uD7FF]")
-        RE_CJK = re.compile(r"[\u4E00-\u9FFF\u3400-\u4DBF\uF900-\uFAFF]")
-
-        has_hiragana = bool(RE_HIRAGANA.search(message_content))
-        has_katakana = bool(RE_KATAKANA.search(message_content))
-        has_hangul = bool(RE_HANGUL.search(message_content))
-        has_cjk = bool(RE_CJK.search(message_content))
-
-        if has_hangul:
-            translated_text = ollama.translate_text(message_content, "ko", "ja")
-            await message.channel.send(f"翻訳結果 (韓国語→日本語):\n{translated_text}")
-        elif has_hiragana or has_katakana or has_cjk:
-            translated_text = ollama.translate_text(message_content, "ja", "ko")
-            await message.channel.send(f"翻訳結果 (日本語→韓国語):\n{translated_text}")
+        # URL・メンション・絵文字・コードを除き、笑いや記号だけならモデルに送らない
+        with metrics.stage("detect"):
+            cleaned = prefilter.clean_text(message_content)
+            trivial = prefilter.is_trivial(cleaned)
+            language = None if trivial else utils.analyze_language(cleaned).language
+        if trivial:
+            prefilter.stats["skipped"] += 1
+            metrics.set_kind("skipped")
+            return
+
+        if language in DIRECTIONS:
+            await send_translation(message, cleaned, *DIRECTIONS[language])
         else:
-            await message.channel.send("翻訳できません。日本語または韓国語を入力してください。")
+            await outbox.send(message.channel, "翻訳できません。日本語または韓国語を入力してください。")
 
 # client.run(TOKEN) は main.py で実行
\ No newline at end of file
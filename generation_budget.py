@@ -0,0 +1,152 @@
+from typing import Dict, List, Optional
+
+from settings import settings
+
+from metrics import metrics
+
+# 翻訳の出力トークン数の上限 = 基本 + 入力1文字あたりの係数 × 文字数（発音の行も含む）
+TRANSLATE_PREDICT_BASE = settings.get_int("TRANSLATION_PREDICT_BASE", 24)
+TRANSLATE_PREDICT_PER_CHAR = settings.get_float("TRANSLATION_PREDICT_PER_CHAR", 2.5)
+# 訳す先の言語ごとの倍率（韓国語訳はカタカナの発音が長くなりやすい）
+DIRECTION_FACTOR = {"ko": 1.3, "ja": 1.0}
+# Q&A の出力トークン数の上限 = 基本 + 質問1文字あたりの係数 × 文字数（THINK_MAX_PREDICT まで）
+THINK_PREDICT_BASE = settings.get_int("THINK_PREDICT_BASE", 400)
+THINK_PREDICT_PER_CHAR = 4
+THINK_MAX_PREDICT = settings.get_int("THINK_MAX_PREDICT", 1000)
+# Q&A の質問として見込むトークン数（コンテキスト長の見積もり用）
+THINK_PROMPT_TOKENS = 1024
+# システムプロンプト・テンプレートの分として見込むトークン数
+SYSTEM_TOKENS = 256
+# コンテキスト長はこの単位で切り上げる
+CONTEXT_STEP = 256
+# 打ち切られた（done_reason=length）翻訳をやり直すときの上限の倍率
+RETRY_FACTOR = 2
+
+# 2行フォーマットの後で止める文字列（Modelfile の例の続きを書き始めた場合）。
+# 訳の前に空行が入ることがあるので空行では止めず、2行そろったかは translation_complete で見る
+TRANSLATE_STOP = ["\nユーザー:", "\nモデル:", "\n【", "<end_of_turn>"]
+# まとめ翻訳の指示文のうち項目以外の分として見込むトークン数
+BATCH_PROMPT_TOKENS = 64
+# まとめ翻訳で1項目あたりに足す番号の分のトークン数
+BATCH_ITEM_TOKENS = 4
+
+
+def prompt_tokens(chars: int) -> int:
+    # 日本語・韓国語はおおよそ1文字1トークン以下なので、文字数を上限の見積もりとして使う
+    return chars + 16
+
+
+def round_context(tokens: int) -> int:
+    return -(-tokens // CONTEXT_STEP) * CONTEXT_STEP
+
+
+class GenerationBudget:
+    """入力の長さから出力トークン数・コンテキスト長の上限を決め、打ち切りの回数を記録する。
+
+    num_ctx はモデルごとに固定の値を使う（リクエストごとに変えると Ollama がモデルを読み込み直すため）。
+    """
+
+    def __init__(self):
+        self._context_sizes: Dict[str, int] = {}
+        self.early_stops = 0
+        self.truncated = 0
+        self.retries = 0
+        self.requests = 0
+        self.eval_tokens = 0
+
+    def set_context_size(self, model: str, num_ctx: int) -> None:
+        self._context_sizes[model] = num_ctx
+
+    def context_size(self, model: str) -> Optional[int]:
+        return self._context_sizes.get(model)
+
+    def _options(self, model: str, num_predict: int, stop: Optional[List[str]] = None) -> dict:
+        options = {"num_predict": num_predict}
+        num_ctx = self.context_size(model)
+        if num_ctx:
+            options["num_ctx"] = num_ctx
+        if stop:
+            options["stop"] = stop
+        return options
+
+    @staticmethod
+    def translate_predict(chars: int, target_lang: Optional[str]) -> int:
+        # 言語がわからなければ多い方に合わせる
+        factor = DIRECTION_FACTOR.get(target_lang, max(DIRECTION_FACTOR.values()))
+        return int(TRANSLATE_PREDICT_BASE + TRANSLATE_PREDICT_PER_CHAR * factor * chars)
+
+    def translate_context(self, max_chars: int) -> int:
+        """max_chars 文字までの翻訳に足りるコンテキスト長"""
+        return round_context(SYSTEM_TOKENS + prompt_tokens(max_chars) + self.translate_predict(max_chars, None))
+
+    def batch_context(self, max_items: int, max_chars: int) -> int:
+        """max_chars 文字までの項目を max_items 件まとめた翻訳に足りるコンテキスト長"""
+        per_item = prompt_tokens(max_chars) + self.translate_predict(max_chars, None) + 2 * BATCH_ITEM_TOKENS
+        return round_context(SYSTEM_TOKENS + BATCH_PROMPT_TOKENS + max_items * per_item)
+
+    def think_context(self, max_history: int) -> int:
+        """max_history トークンまでの会話の続きに足りるコンテキスト長"""
+        return round_context(SYSTEM_TOKENS + max_history + THINK_PROMPT_TOKENS + THINK_MAX_PREDICT)
+
+    def translate_options(self, model: str, text: str, target_lang: str) -> dict:
+        return self._options(model, self.translate_predict(len(text), target_lang), TRANSLATE_STOP)
+
+    def batch_options(self, model: str, texts: List[str], target_lang: str) -> dict:
+        # 番号の分を1項目あたり数トークン足す
+        num_predict = sum(self.translate_predict(len(text), target_lang) + BATCH_ITEM_TOKENS for text in texts)
+        num_ctx = self.context_size(model)
+        if num_ctx:
+            prompt = BATCH_PROMPT_TOKENS + sum(prompt_tokens(len(text)) + BATCH_ITEM_TOKENS for text in texts)
+            num_predict = max(1, min(num_predict, num_ctx - SYSTEM_TOKENS - prompt))
+        return self._options(model, num_predict, TRANSLATE_STOP)
+
+    def think_options(self, model: str, text: str) -> dict:
+        num_predict = min(THINK_MAX_PREDICT, THINK_PREDICT_BASE + THINK_PREDICT_PER_CHAR * len(text))
+        return self._options(model, num_predict)
+
+    def relaxed(self, options: dict) -> dict:
+        """打ち切られたときのやり直し用（上限を広げ、止める文字列を外す）"""
+        self.retries += 1
+        relaxed = {k: v for k, v in options.items() if k != "stop"}
+        relaxed["num_predict"] = options["num_predict"] * RETRY_FACTOR
+        return relaxed
+
+    @staticmethod
+    def translation_complete(output: str) -> bool:
+        """訳と発音の2行が出そろったか（発音の行の後に改行が来たら完了とみなす）"""
+        lines = output.split("\n")
+        seen_translation = False
+        # 最後の行はまだ書きかけかもしれないので見ない
+        for line in lines[:-1]:
+            if "発音:" in line or "발음:" in line:
+                if seen_translation:
+                    return True
+            elif line.strip():
+                seen_translation = True
+        return False
+
+    def observe(self, data: dict, early_stop: bool = False) -> bool:
+        """生成の最後のチャンク（または応答）を記録する。上限で打ち切られていれば True"""
+        self.requests += 1
+        self.eval_tokens += data.get("eval_count", 0)
+        if early_stop:
+            self.early_stops += 1
+            return False
+        if data.get("done_reason") == "length":
+            self.truncated += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "eval_tokens": self.eval_tokens,
+            "early_stops": self.early_stops,
+            "truncated": self.truncated,
+            "retries": self.retries,
+        }
+
+
+# Bot 全体で共有する生成量の上限
+budget = GenerationBudget()
+metrics.add_collector("generation", budget.stats)
@@ -1,5 +1,31 @@
 #!/usr/bin/env python3
-from discord_bot import client, TOKEN
+import startup
+
+import asyncio
+import sys
+
+with startup.measure("ollama_client"):
+    import ollama_client
+with startup.measure("discord_bot"):
+    from discord_bot import client, TOKEN
+from metrics import metrics
+
+
+async def main():
+    try:
+        async with client:
+            await client.start(TOKEN)
+    finally:
+        # Ollama との keep-alive 接続を閉じる
+        await ollama_client.close_session()
+        await metrics.stop()
+        # 音楽コマンドが使われていれば yt-dlp のワーカーも止める
+        if "ytdl_executor" in sys.modules:
+            sys.modules["ytdl_executor"].shutdown()
+
 
 if __name__ == "__main__":
-    client.run(TOKEN)
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
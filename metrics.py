@@ -0,0 +1,256 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from settings import settings
+
+# Prometheus 形式のメトリクスを返す HTTP サーバー（0 で無効）。外からは見えないよう既定は localhost のみ
+METRICS_HOST = settings.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = settings.get_int("METRICS_PORT", 9464)
+# この秒数以上かかった応答は段階ごとの内訳を表示する（0 で無効）
+SLOW_REQUEST = settings.get_float("METRICS_SLOW_REQUEST", 5.0)
+# イベントループの遅延を測る間隔（秒、0 で無効）
+LAG_INTERVAL = settings.get_float("METRICS_LAG_INTERVAL", 0.5)
+# ヒストグラムの区切り（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """区切りの上端で近似したパーセンタイル"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+class Trace:
+    """1つのメッセージの処理にかかった時間の段階ごとの内訳"""
+
+    __slots__ = ("kind", "start", "stages")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.start = time.monotonic()
+        self.stages: List[Tuple[str, float]] = []
+
+    def breakdown(self) -> str:
+        return " / ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages)
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """ヒストグラム・カウンター・各モジュールの統計（ゲージ）を集めて Prometheus 形式で返す"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        # 名前 -> (統計を返す関数, 入れ子の辞書のキーに付けるラベル名)
+        self._collectors: Dict[str, Tuple[Callable[[], dict], str]] = {}
+        self.lag_max = 0.0
+        self._lag_task: Optional[asyncio.Task] = None
+        # aiohttp.web.AppRunner（HTTP サーバーを起動したときだけ）
+        self._runner = None
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        series = self.counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+    def add_collector(self, name: str, collect: Callable[[], dict], label: str = "name") -> None:
+        """stats() の数値をゲージとして出す。値が辞書ならそのキーを label のラベルにする"""
+        self._collectors[name] = (collect, label)
+
+    # --- トレース ---
+
+    @contextmanager
+    def request(self, kind: str = "other"):
+        """メッセージ1件の処理全体を計測する（中の stage() はこのトレースにも記録される）"""
+        trace = Trace(kind)
+        token = _trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _trace.reset(token)
+            elapsed = time.monotonic() - trace.start
+            self.observe("bot_request_seconds", elapsed, kind=trace.kind)
+            self.inc("bot_requests_total", kind=trace.kind)
+            if SLOW_REQUEST and elapsed >= SLOW_REQUEST:
+                print(f"遅い応答 ({trace.kind}, {elapsed:.2f}s): {trace.breakdown()}")
+
+    def set_kind(self, kind: str) -> None:
+        trace = _trace.get()
+        if trace is not None:
+            trace.kind = kind
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.monotonic() - start)
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        self.observe("bot_stage_seconds", seconds, stage=name)
+        trace = _trace.get()
+        if trace is not None:
+            trace.stages.append((name, seconds))
+
+    def observe_generation(self, model: str, data: dict) -> None:
+        """Ollama の応答（最後のチャンク）に含まれる処理時間を記録する"""
+        for field, stage in (("load_duration", "load"), ("prompt_eval_duration", "prompt_eval"),
+                             ("eval_duration", "decode")):
+            nanoseconds = data.get(field)
+            if nanoseconds:
+                seconds = nanoseconds / 1e9
+                self.observe(f"ollama_{stage}_seconds", seconds, model=model)
+                trace = _trace.get()
+                if trace is not None:
+                    trace.stages.append((stage, seconds))
+        self.inc("ollama_prompt_tokens_total", data.get("prompt_eval_count", 0), model=model)
+        self.inc("ollama_eval_tokens_total", data.get("eval_count", 0), model=model)
+
+    # --- イベントループの遅延 ---
+
+    async def _measure_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+            self.observe("event_loop_lag_seconds", lag)
+            self.lag_max = max(self.lag_max, lag)
+
+    # --- 出力 ---
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    bucket_labels = _format_labels(labels, f'le="{le}"')
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum:g}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for name, (collect, label) in self._collectors.items():
+            try:
+                values = collect()
+            except Exception as e:
+                print(f"統計の取得に失敗しました ({name}): {e}")
+                continue
+            for key, value in values.items():
+                metric = f"bot_{name}_{key}"
+                if isinstance(value, dict):
+                    lines.append(f"# TYPE {metric} gauge")
+                    for sub, number in value.items():
+                        if isinstance(number, (int, float)):
+                            lines.append(f'{metric}{{{label}="{sub}"}} {float(number):g}')
+                elif isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {metric} gauge")
+                    lines.append(f"{metric} {float(value):g}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """チャット表示用の要約（段階ごとの件数・平均・p50/p95）"""
+        msg = "⏱️ **処理時間**\n"
+        for name, label in (("bot_request_seconds", "kind"), ("bot_stage_seconds", "stage"),
+                            ("ollama_prompt_eval_seconds", "model"), ("ollama_decode_seconds", "model"),
+                            ("ollama_load_seconds", "model")):
+            for labels, h in sorted(self.histograms.get(name, {}).items()):
+                tag = dict(labels).get(label, "")
+                prefix = name.removeprefix("bot_").removeprefix("ollama_").removesuffix("_seconds")
+                msg += (
+                    f"`{prefix}:{tag}` {h.count}件 / 平均 {h.sum / h.count:.2f}s / "
+                    f"p50 ≤{h.quantile(0.5):g}s / p95 ≤{h.quantile(0.95):g}s\n"
+                )
+        lag = self.histograms.get("event_loop_lag_seconds", {}).get(())
+        if lag is not None and lag.count:
+            msg += f"イベントループの遅延: 平均 {lag.sum / lag.count * 1000:.1f}ms / 最大 {self.lag_max * 1000:.1f}ms\n"
+        return msg
+
+    # --- 起動・停止 ---
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def start(self) -> None:
+        """遅延の計測と HTTP サーバーを開始する（複数回呼んでもよい）"""
+        if LAG_INTERVAL > 0 and (self._lag_task is None or self._lag_task.done()):
+            self._lag_task = asyncio.create_task(self._measure_lag())
+        if METRICS_PORT and self._runner is None:
+            # aiohttp.web は起動時間を増やさないようにここで読み込む
+            from aiohttp import web
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            try:
+                await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+            except OSError as e:
+                print(f"メトリクスのサーバーを起動できません ({METRICS_HOST}:{METRICS_PORT}): {e}")
+                await runner.cleanup()
+                return
+            self._runner = runner
+            print(f"メトリクス: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    async def stop(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Bot 全体で共有するメトリクス
+metrics = Metrics()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""ベンチマーク用の Ollama 代替サーバー（/api/generate のみ）
+
+GPU なしで翻訳経路を計測するため、トークンごとの遅延を設定して疑似的に生成する。
+
+    python mock_ollama.py --port 11435 --token-latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+
+from aiohttp import web
+
+# まとめ翻訳のプロンプト（ollama._build_batch_payload）
+RE_BATCH = re.compile(r"次の(\d+)件をそれぞれ")
+# /api/tags で返すインストール済みモデル（それ以外のモデル名でも生成はできる）
+INSTALLED_MODELS = ("my-translator:latest", "gemma3:12b")
+
+
+class MockOllama:
+    def __init__(self, token_latency=0.02, prompt_latency=0.05, load_latency=0.0,
+                 answer_tokens=200, parallel=1, ramble=0):
+        self.token_latency = token_latency
+        self.prompt_latency = prompt_latency
+        self.load_latency = load_latency
+        self.answer_tokens = answer_tokens
+        # 翻訳の2行の後に続ける余計な出力の文字数（止める文字列・早期停止の確認用）
+        self.ramble = ramble
+        # 同時に生成できる数（GPU の並列度を模擬）
+        self.gpu = asyncio.Semaphore(parallel)
+        self.loaded = set()
+        self.requests = 0
+        # 実際に生成した（クライアントに送った）トークン数
+        self.generated = 0
+
+    def _tokens(self, payload: dict):
+        """(トークンのリスト, done_reason) を返す"""
+        prompt = payload.get("prompt", "")
+        batch = RE_BATCH.search(prompt)
+        if batch:
+            count = int(batch.group(1))
+            text = "\n".join(f"{i}. 訳文{i}\n発音: ヤクブン{i}" for i in range(1, count + 1))
+        elif "韓国語に翻訳" in prompt:
+            text = "안녕하세요\n発音: アンニョンハセヨ"
+        elif "日本語に翻訳" in prompt:
+            text = "こんにちは\n発音: 곤니치와"
+        else:
+            text = "テスト" * self.answer_tokens
+        if self.ramble and not batch and "翻訳" in prompt:
+            text += "\n補足: " + "説明" * (self.ramble // 2)
+        options = payload.get("options", {})
+        for stop in options.get("stop", []):
+            if stop in text:
+                text = text[:text.index(stop)]
+        limit = options.get("num_predict")
+        # 2文字を1トークンとみなす
+        tokens = [text[i:i + 2] for i in range(0, len(text), 2)]
+        if limit and 0 < limit < len(tokens):
+            return tokens[:limit], "length"
+        return tokens, "stop"
+
+    async def handle_tags(self, request: web.Request) -> web.Response:
+        names = sorted(set(INSTALLED_MODELS) | self.loaded)
+        return web.json_response({"models": [{"name": name} for name in names]})
+
+    async def handle_ps(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": name, "expires_at": "2099-01-01T00:00:00Z"}
+                                             for name in sorted(self.loaded)]})
+
+    async def handle_generate(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.requests += 1
+        model = payload.get("model", "")
+        prompt = payload.get("prompt", "")
+
+        # プロンプトなしのリクエストは読み込み / keep_alive=0 なら解放
+        if not prompt:
+            if payload.get("keep_alive") == 0:
+                self.loaded.discard(model)
+                return web.json_response({"model": model, "response": "", "done": True, "done_reason": "unload"})
+            async with self.gpu:
+                load_duration = 0.0
+                if model not in self.loaded:
+                    await asyncio.sleep(self.load_latency)
+                    load_duration = self.load_latency
+                    self.loaded.add(model)
+            return web.json_response({"model": model, "response": "", "done": True, "done_reason": "load",
+                                      "load_duration": int(load_duration * 1e9)})
+
+        tokens, done_reason = self._tokens(payload)
+
+        async with self.gpu:
+            load_duration = 0.0
+            if model not in self.loaded:
+                await asyncio.sleep(self.load_latency)
+                load_duration = self.load_latency
+                self.loaded.add(model)
+            start = time.monotonic()
+            await asyncio.sleep(self.prompt_latency)
+            prompt_eval_duration = time.monotonic() - start
+
+            final = {
+                "model": model,
+                "done": True,
+                "done_reason": done_reason,
+                "prompt_eval_count": len(prompt),
+                "eval_count": len(tokens),
+                "load_duration": int(load_duration * 1e9),
+                "prompt_eval_duration": int(prompt_eval_duration * 1e9),
+                # 会話の続きに使うトークン列（中身は意味のない番号。前回の context に今回の分を足す）
+                "context": list(payload.get("context") or []) + list(range(len(prompt) + len(tokens))),
+            }
+
+            if not payload.get("stream", True):
+                start = time.monotonic()
+                await asyncio.sleep(self.token_latency * len(tokens))
+                self.generated += len(tokens)
+                final["eval_duration"] = int((time.monotonic() - start) * 1e9)
+                final["total_duration"] = final["load_duration"] + final["prompt_eval_duration"] + final["eval_duration"]
+                return web.json_response({**final, "response": "".join(tokens)})
+
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+            start = time.monotonic()
+            try:
+                for token in tokens:
+                    await asyncio.sleep(self.token_latency)
+                    self.generated += 1
+                    chunk = {"model": model, "response": token, "done": False}
+                    await response.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8"))
+            except ConnectionResetError:
+                # クライアントが途中で切断した（Ollama も生成を止める）
+                return response
+            final["eval_duration"] = int((time.monotonic() - start) * 1e9)
+            final["total_duration"] = final["load_duration"] + final["prompt_eval_duration"] + final["eval_duration"]
+            await response.write((json.dumps({**final, "response": ""}) + "\n").encode("utf-8"))
+            await response.write_eof()
+            return response
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/generate", self.handle_generate)
+        app.router.add_get("/api/tags", self.handle_tags)
+        app.router.add_get("/api/ps", self.handle_ps)
+        return app
+
+
+async def start_server(mock: MockOllama, host: str = "127.0.0.1", port: int = 0):
+    """サーバーを起動し (runner, url) を返す。port=0 なら空きポートを使う"""
+    runner = web.AppRunner(mock.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    actual_port = runner.addresses[0][1]
+    return runner, f"http://{host}:{actual_port}/api/generate"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用の Ollama 代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--token-latency", type=float, default=0.02, help="1トークンあたりの生成時間（秒）")
+    parser.add_argument("--prompt-latency", type=float, default=0.05, help="プロンプト処理時間（秒）")
+    parser.add_argument("--load-latency", type=float, default=0.0, help="初回のモデル読み込み時間（秒）")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="Q&A 応答のトークン数")
+    parser.add_argument("--parallel", type=int, default=1, help="同時に生成できる数")
+    parser.add_argument("--ramble", type=int, default=0, help="翻訳の2行の後に続ける余計な出力の文字数")
+    args = parser.parse_args()
+
+    mock = MockOllama(args.token_latency, args.prompt_latency, args.load_latency,
+                      args.answer_tokens, args.parallel, args.ramble)
+    web.run_app(mock.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
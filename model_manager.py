@@ -0,0 +1,174 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from settings import settings
+
+import ollama_client
+from generation_budget import budget
+
+# モデルをメモリに残す時間の既定値（Ollama の keep_alive 形式: "30m", "-1" で無期限）
+KEEP_ALIVE = settings.get("MODEL_KEEP_ALIVE", "30m")
+# モデル別の上書き（例: "my-translator=-1,gemma3:12b=10m"）
+KEEP_ALIVE_OVERRIDES = settings.get("MODEL_KEEP_ALIVE_OVERRIDES", "")
+# 保温のために空リクエストを送る間隔（秒）。0 なら送らない
+WARM_INTERVAL = settings.get_float("MODEL_WARM_INTERVAL", 240)
+# この秒数以上の load_duration はモデルの読み込み（＝追い出されていた）とみなす
+COLD_LOAD_THRESHOLD = settings.get_float("MODEL_COLD_LOAD_THRESHOLD", 1.0)
+
+
+def _parse_overrides(spec: str) -> Dict[str, str]:
+    overrides = {}
+    for item in spec.split(","):
+        if "=" in item:
+            model, value = item.rsplit("=", 1)
+            overrides[model.strip()] = value.strip()
+    return overrides
+
+
+def _keep_alive_value(value: str):
+    # 数値だけなら秒数として送る（"-1" は無期限）
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class ModelState:
+    def __init__(self):
+        self.last_used = 0.0
+        self.last_load_duration = 0.0
+        self.cold_starts = 0
+        self.evictions = 0
+        self.requests = 0
+
+
+class ModelManager:
+    """モデルの事前読み込み・保温・追い出し検知を行う"""
+
+    def __init__(self, keep_alive: str = KEEP_ALIVE, overrides: Dict[str, str] = None,
+                 warm_interval: float = WARM_INTERVAL):
+        self.default_keep_alive = keep_alive
+        self.overrides = overrides or {}
+        self.warm_interval = warm_interval
+        self.models: Dict[str, ModelState] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def keep_alive(self, model: str):
+        return _keep_alive_value(self.overrides.get(model, self.default_keep_alive))
+
+    def _state(self, model: str) -> ModelState:
+        if model not in self.models:
+            self.models[model] = ModelState()
+        return self.models[model]
+
+    def observe(self, model: str, data: dict) -> None:
+        """生成のレスポンスから load_duration を記録し、コールドスタートを検知する"""
+        state = self._state(model)
+        state.requests += 1
+        state.last_used = time.monotonic()
+        load_duration = data.get("load_duration", 0) / 1e9
+        if load_duration:
+            state.last_load_duration = load_duration
+        if load_duration >= COLD_LOAD_THRESHOLD:
+            state.cold_starts += 1
+            print(f"モデル {model} の読み込みが発生しました ({load_duration:.1f}s)")
+
+    async def preload(self, model: str) -> None:
+        """モデルを扱う全サーバーにプロンプトなしのリクエストを送って読み込ませ、keep_alive を延長する"""
+        backends = ollama_client.pool.candidates(model)
+        await asyncio.gather(*(self._preload_on(model, backend) for backend in backends))
+
+    async def _preload_on(self, model: str, backend) -> None:
+        state = self._state(model)
+        payload = {"model": model, "keep_alive": self.keep_alive(model)}
+        # 生成時と同じコンテキスト長で読み込む（違うと最初のリクエストで読み込み直しになる）
+        num_ctx = budget.context_size(model)
+        if num_ctx:
+            payload["options"] = {"num_ctx": num_ctx}
+        try:
+            data = await ollama_client.generate(payload, backend)
+        except Exception as e:
+            print(f"モデル {model} の読み込みに失敗しました ({backend.base_url}): {e}")
+            return
+        load_duration = data.get("load_duration", 0) / 1e9
+        if load_duration:
+            state.last_load_duration = load_duration
+        # 一度使われた後に読み込みが必要だった＝その間に追い出されていた
+        if load_duration >= COLD_LOAD_THRESHOLD and state.requests:
+            state.evictions += 1
+            print(f"モデル {model} が追い出されていたため再読み込みしました ({backend.base_url}, {load_duration:.1f}s)")
+        state.last_used = time.monotonic()
+
+    async def start(self, models: List[str]) -> None:
+        """起動時に全モデルを読み込み、保温タスクを開始する（複数回呼んでもよい）"""
+        for model in models:
+            self._state(model)
+        await asyncio.gather(*(self.preload(model) for model in models))
+        if self.warm_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._keep_warm())
+
+    async def _keep_warm(self) -> None:
+        while True:
+            await asyncio.sleep(self.warm_interval)
+            now = time.monotonic()
+            for model, state in list(self.models.items()):
+                # 最近使われたモデルは keep_alive が延長済みなので送らない
+                if now - state.last_used >= self.warm_interval:
+                    await self.preload(model)
+
+    async def status(self) -> str:
+        """チャット表示用のモデル状態（サーバーごとの読み込み状況も含む）"""
+        backends = ollama_client.pool.backends
+
+        async def running(backend):
+            try:
+                data = await ollama_client.get_json("/api/ps", backend)
+                return {m.get("name"): m for m in data.get("models", [])}
+            except Exception as e:
+                print(f"/api/ps の取得に失敗しました ({backend.base_url}): {e}")
+                return None
+
+        loaded_by_backend = await asyncio.gather(*(running(backend) for backend in backends))
+
+        msg = "🧠 **モデル状態**\n"
+        for model, state in self.models.items():
+            places = []
+            for backend, loaded in zip(backends, loaded_by_backend):
+                if not backend.serves(model):
+                    continue
+                if loaded is None:
+                    where = "不明"
+                elif model in loaded or f"{model}:latest" in loaded:
+                    info = loaded.get(model) or loaded.get(f"{model}:latest")
+                    where = f"読み込み済み（期限: {info.get('expires_at', '?')[:19]}）"
+                else:
+                    where = "未読み込み"
+                places.append(f"{backend.base_url} {where}" if len(backends) > 1 else where)
+            where = " / ".join(places) or "扱えるサーバーなし"
+            num_ctx = budget.context_size(model)
+            msg += (
+                f"`{model}`: {where} / keep_alive={self.keep_alive(model)} / "
+                f"{f'num_ctx={num_ctx} / ' if num_ctx else ''}"
+                f"最終読込 {state.last_load_duration:.1f}s / "
+                f"コールドスタート {state.cold_starts}回 / 追い出し検知 {state.evictions}回\n"
+            )
+
+        usage = budget.stats()
+        msg += (
+            f"出力 {usage['eval_tokens']}トークン / 2行そろって停止 {usage['early_stops']}回 / "
+            f"上限で打ち切り {usage['truncated']}回（やり直し {usage['retries']}回）\n"
+        )
+
+        if len(backends) > 1:
+            msg += "\n🖥️ **サーバー**\n"
+            for b in ollama_client.pool.stats():
+                msg += (
+                    f"{b['url']}: {b['state']} / 処理中 {b['outstanding']} / "
+                    f"平均 {b['latency']:.2f}s / {b['requests']}件（エラー {b['errors']}）\n"
+                )
+        return msg
+
+
+# Bot 全体で共有するマネージャー
+manager = ModelManager(overrides=_parse_overrides(KEEP_ALIVE_OVERRIDES))
@@ -0,0 +1,156 @@
+import json
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+from settings import settings
+
+from metrics import metrics
+
+# 曲名・長さ・再生リストの中身の有効期限（秒）
+METADATA_TTL = settings.get_float("MUSIC_METADATA_TTL", 7 * 24 * 3600)
+# メモリ上に保持する件数
+METADATA_CACHE_SIZE = settings.get_int("MUSIC_METADATA_CACHE_SIZE", 500)
+STREAM_CACHE_SIZE = settings.get_int("MUSIC_STREAM_CACHE_SIZE", 500)
+# SQLite の保存先（空ならメモリのみ）
+CACHE_DB = settings.get("MUSIC_CACHE_DB", "")
+
+RE_VIDEO_ID = re.compile(r"^[\w-]{11}$")
+
+
+def normalize_key(url: str, playlist: bool = True) -> str:
+    """URL を動画ID / 再生リストIDのキーにする（同じ曲の別表記をまとめる）
+
+    playlist=False なら list= を無視して動画IDのキーにする（音声URL用）。
+    """
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().removeprefix("www.").removeprefix("m.").removeprefix("music.")
+    query = parse_qs(parsed.query)
+
+    if host in ("youtube.com", "youtu.be"):
+        # 再生リスト付きのURLは yt-dlp が再生リストとして扱う
+        if playlist and "list" in query:
+            return f"youtube:playlist:{query['list'][0]}"
+        if host == "youtu.be":
+            video_id = parsed.path.strip("/")
+        elif "v" in query:
+            video_id = query["v"][0]
+        else:
+            # /shorts/ID, /live/ID, /embed/ID
+            video_id = parsed.path.rstrip("/").rsplit("/", 1)[-1]
+        if RE_VIDEO_ID.match(video_id):
+            return f"youtube:video:{video_id}"
+
+    return f"url:{url.strip()}"
+
+
+_db: Optional[sqlite3.Connection] = None
+
+
+def connect() -> Optional[sqlite3.Connection]:
+    """SQLite を開く（CACHE_DB が空なら None）。
+
+    vc_music は別スレッドで import されるので、import 時ではなく最初に使うとき
+    （イベントループのスレッド）に開く。SQLite の接続は開いたスレッドでしか使えない。
+    """
+    global _db
+    if _db is None and CACHE_DB:
+        _db = sqlite3.connect(CACHE_DB)
+    return _db
+
+
+class ExpiringCache:
+    """エントリごとに有効期限を持つLRUキャッシュ。persistent なら SQLite（CACHE_DB）にも保存する"""
+
+    def __init__(self, name: str, max_entries: int, persistent: bool = False):
+        self.name = name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._persistent = persistent
+        self._table_ready = False
+
+    @property
+    def _db(self) -> Optional[sqlite3.Connection]:
+        db = connect() if self._persistent else None
+        if db is not None and not self._table_ready:
+            db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            db.commit()
+            self._table_ready = True
+        return db
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        db = self._db
+        if entry is None and db is not None:
+            row = db.execute(
+                f"SELECT value, expires FROM {self.name} WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                entry = (json.loads(row[0]), row[1])
+                self._store(key, entry)
+
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                self._delete(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: dict, expires: float) -> None:
+        self._store(key, (value, expires))
+        db = self._db
+        if db is not None:
+            db.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires),
+            )
+            # ディスク側も件数を制限する（期限切れと、期限の近い古いものから消す）
+            db.execute(f"DELETE FROM {self.name} WHERE expires <= ?", (time.time(),))
+            db.execute(
+                f"DELETE FROM {self.name} WHERE key NOT IN "
+                f"(SELECT key FROM {self.name} ORDER BY expires DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            db.commit()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _store(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+        db = self._db
+        if db is not None:
+            db.execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+            db.commit()
+
+
+# 曲名・長さ・再生リストの中身（長い有効期限）
+metadata = ExpiringCache("metadata", METADATA_CACHE_SIZE, persistent=True)
+# 再生用の音声URL（URL自体の有効期限まで）
+streams = ExpiringCache("streams", STREAM_CACHE_SIZE, persistent=True)
+
+
+def stats() -> dict:
+    """項目 -> {キャッシュ名: 値}"""
+    caches = (metadata, streams)
+    return {key: {cache.name: cache.stats()[key] for cache in caches} for key in ("entries", "hits", "misses")}
+
+
+metrics.add_collector("music_cache", stats, label="cache")
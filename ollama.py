@@ -1,32 +1,117 @@
-import requests
-import json
-import os
+import asyncio
 import re
-from dotenv import load_dotenv
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
 
-load_dotenv()
-url = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+from settings import settings
+
+from batcher import MicroBatcher
+from generation_budget import budget
+from metrics import metrics
+from model_manager import manager
+from scheduler import PRIORITY_TRANSLATE, scheduler
+from translation_cache import cache
+
+# ★変更点: 作成したカスタムモデル名を指定
+MODEL_NAME = "my-translator"
+
+# まとめ翻訳の待ち時間（秒）。0 なら無効
+BATCH_WINDOW = settings.get_float("TRANSLATION_BATCH_WINDOW", 0)
+# 1回にまとめる最大件数
+BATCH_MAX_ITEMS = settings.get_int("TRANSLATION_BATCH_MAX_ITEMS", 8)
+# まとめ翻訳の対象にする最大文字数（長文は単独で翻訳する）
+BATCH_MAX_CHARS = settings.get_int("TRANSLATION_BATCH_MAX_CHARS", 200)
+
+# 長文はこの文字数以下の塊に分けて並列に翻訳する
+CHUNK_MAX_CHARS = settings.get_int("TRANSLATION_CHUNK_CHARS", 200)
+# 1つのメッセージで同時に翻訳する塊の数
+CHUNK_CONCURRENCY = settings.get_int("TRANSLATION_CHUNK_CONCURRENCY", 3)
+# 塊ごとの訳をつなげるときの区切り
+CHUNK_SEPARATOR = "\n\n"
+# 翻訳モデルのコンテキスト長（0 なら1件の翻訳と、最大件数のまとめ翻訳の大きい方から見積もる。
+# 編集時の文ごとのまとめ翻訳は塊の最大文字数までの文を BATCH_MAX_ITEMS 件まとめる）
+NUM_CTX = settings.get_int("TRANSLATION_NUM_CTX", 0) or max(
+    budget.translate_context(CHUNK_MAX_CHARS),
+    budget.batch_context(BATCH_MAX_ITEMS, max(CHUNK_MAX_CHARS, BATCH_MAX_CHARS)),
+)
+budget.set_context_size(MODEL_NAME, NUM_CTX)
+
+# まとめ翻訳の出力の「1. 」「2) 」などの番号
+RE_ITEM_NUMBER = re.compile(r"^(\d+)\s*[.．)）:：]\s*")
+# 1文（句点・感嘆符・疑問符、または空白が続くピリオドまで。閉じ括弧も含める）
+RE_SENTENCE = re.compile(r".*?(?:[。！？!?]+[」』）)]*|\.(?=\s)|$)\s*")
+# 長すぎる文を切るときに優先する位置
+BREAK_CHARS = " 、，,"
+
+def _split_long_sentence(sentence: str, max_chars: int) -> List[str]:
+    pieces = []
+    while len(sentence) > max_chars:
+        cut = max(sentence.rfind(c, 0, max_chars) for c in BREAK_CHARS) + 1
+        if cut <= max_chars // 2:
+            cut = max_chars
+        pieces.append(sentence[:cut])
+        sentence = sentence[cut:]
+    if sentence.strip():
+        pieces.append(sentence)
+    return pieces
+
+def split_chunks(text: str, max_chars: int = CHUNK_MAX_CHARS) -> List[str]:
+    """翻訳用に、行（段落）と文の区切りで max_chars 以下の塊に分ける。
+
+    モデルは1行の入力に対して「訳・発音」の2行を返すので、塊は改行を含まないようにする。
+    """
+    chunks = []
+    for line in text.splitlines():
+        current = ""
+        for sentence in RE_SENTENCE.findall(line.strip()):
+            if not sentence.strip():
+                continue
+            if len(current) + len(sentence) <= max_chars:
+                current += sentence
+                continue
+            if current.strip():
+                chunks.append(current.strip())
+            current = ""
+            if len(sentence) > max_chars:
+                *head, current = _split_long_sentence(sentence, max_chars)
+                chunks.extend(piece.strip() for piece in head)
+            else:
+                current = sentence
+        if current.strip():
+            chunks.append(current.strip())
+    return chunks
+
+def split_sentences(text: str, max_chars: int = CHUNK_MAX_CHARS) -> List[str]:
+    """行と文の区切りで1文ずつに分ける（長すぎる文は max_chars 以下に切る）。
+
+    編集されたメッセージで、変わった塊のうち前回と違う文だけを翻訳し直すのに使う。
+    """
+    sentences = []
+    for line in text.splitlines():
+        for sentence in RE_SENTENCE.findall(line.strip()):
+            if len(sentence) > max_chars:
+                sentences.extend(piece.strip() for piece in _split_long_sentence(sentence, max_chars))
+            elif sentence.strip():
+                sentences.append(sentence.strip())
+    return [sentence for sentence in sentences if sentence]
 
 def _post_process_output(text: str) -> str:
     """以前と同じ整形処理（念のため残す）"""
     if not text: return text
     lines = [ln.strip() for ln in text.strip().splitlines() if ln.strip()]
-    
+
     # 発音行を探して抽出するロジック（DeepSeekやGemmaが余計なことを言った時用）
     pronunciation_index = -1
     for i, line in enumerate(lines):
         if "発音:" in line or "발음:" in line:
             pronunciation_index = i
             break
-    
+
     if pronunciation_index > 0:
         return f"{lines[pronunciation_index - 1]}\n{lines[pronunciation_index]}"
     return "\n".join(lines[:2])
 
-def translate_text(text: str, source_lang: str, target_lang: str) -> str:
-    # ★変更点: 作成したカスタムモデル名を指定
-    model_name = "my-translator"
-
+def _build_payload(text: str, target_lang: str) -> dict:
     # プロンプトは「翻訳したい文」だけでOK
     # 言語指定は念のため入れますが、システムプロンプトが強力なら不要な場合も多いです
     if target_lang == "ko":
@@ -34,16 +119,182 @@ def translate_text(text: str, source_lang: str, target_lang: str) -> str:
     else:
         prompt = f"日本語に翻訳: {text}"
 
-    payload = {
-        "model": model_name,
+    return {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": manager.keep_alive(MODEL_NAME),
+        # 入力の長さに見合った出力数の上限と、2行フォーマットの後で止める文字列
+        "options": budget.translate_options(MODEL_NAME, text, target_lang),
+    }
+
+def _build_batch_payload(texts: List[str], target_lang: str) -> dict:
+    lang = "韓国語" if target_lang == "ko" else "日本語"
+    items = "\n".join(f"{i}. {text}" for i, text in enumerate(texts, 1))
+    prompt = (
+        f"次の{len(texts)}件をそれぞれ{lang}に翻訳: "
+        f"各項目を「番号. 翻訳結果」と「発音: 読み」の2行で番号順に出力\n{items}"
+    )
+    return {
+        "model": MODEL_NAME,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "keep_alive": manager.keep_alive(MODEL_NAME),
+        "options": budget.batch_options(MODEL_NAME, texts, target_lang),
     }
 
+def _split_batch_output(text: str, count: int) -> Optional[List[str]]:
+    """まとめ翻訳の出力を項目ごとの2行フォーマットに分割する。形式が崩れていれば None"""
+    lines = [ln.strip() for ln in text.strip().splitlines() if ln.strip()]
+    results = []
+    for i, line in enumerate(lines):
+        if "発音:" in line or "발음:" in line:
+            if i == 0:
+                return None
+            match = RE_ITEM_NUMBER.match(lines[i - 1])
+            if not match or int(match.group(1)) != len(results) + 1:
+                return None
+            translation = lines[i - 1][match.end():].strip()
+            if not translation:
+                return None
+            results.append(f"{translation}\n{line}")
+    if len(results) != count:
+        return None
+    return results
+
+async def _translate_batch(group: tuple, texts: List[str], user: Optional[int] = None) -> Optional[List[str]]:
+    source_lang, target_lang = group
+    payload = _build_batch_payload(texts, target_lang)
+    data = await scheduler.generate(payload, PRIORITY_TRANSLATE, user)
+    # 打ち切られた場合は形式が崩れるので、個別の翻訳にまかせる
+    budget.observe(data)
+    results = _split_batch_output(data.get("response", ""), len(texts))
+    if results is None:
+        return None
+
+    for text, result in zip(texts, results):
+        cache.set(cache.make_key(text, source_lang, target_lang, MODEL_NAME), result)
+    return results
+
+async def _generate(payload: dict, user: Optional[int] = None, retry: bool = True) -> str:
+    data = await scheduler.generate(payload, PRIORITY_TRANSLATE, user)
+    output = data.get("response", "")
+    # 出力数の上限で発音の行の途中までしか出なかったときだけ、上限を広げて1回やり直す
+    if budget.observe(data) and retry and not budget.translation_complete(output):
+        output = await _generate({**payload, "options": budget.relaxed(payload["options"])}, user, False)
+    return output
+
+_batcher = MicroBatcher(BATCH_WINDOW, BATCH_MAX_ITEMS, _translate_batch)
+metrics.add_collector("batcher", _batcher.stats)
+
+async def translate_chunks(chunks: List[str], source_lang: str, target_lang: str,
+                           user: Optional[int] = None) -> List[str]:
+    """塊ごとに（同時に CHUNK_CONCURRENCY 件まで）翻訳し、元の順番で返す"""
+    semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+
+    async def translate_one(chunk: str) -> str:
+        async with semaphore:
+            return await translate_text(chunk, source_lang, target_lang, user)
+
+    return await asyncio.gather(*(translate_one(chunk) for chunk in chunks))
+
+async def translate_sentences(sentences: List[str], source_lang: str, target_lang: str,
+                              user: Optional[int] = None) -> List[str]:
+    """複数の文を番号付きのまとめ翻訳で（BATCH_MAX_ITEMS 件ごとに1回の生成で）翻訳し、文ごとの訳を返す。
+
+    キャッシュにある文はモデルに送らない。出力の形式が崩れた場合は文ごとに翻訳し直す。
+    """
+    results = {}
+    pending = []
+    for sentence in dict.fromkeys(sentences):
+        cached = cache.get(cache.make_key(sentence, source_lang, target_lang, MODEL_NAME))
+        if cached is not None:
+            results[sentence] = cached
+        else:
+            pending.append(sentence)
+
+    for start in range(0, len(pending), BATCH_MAX_ITEMS):
+        group = pending[start:start + BATCH_MAX_ITEMS]
+        translated = None
+        if len(group) > 1:
+            try:
+                with metrics.stage("generate"):
+                    translated = await _translate_batch((source_lang, target_lang), group, user)
+            except Exception as e:
+                print(f"まとめ翻訳エラー: {e}")
+        if translated is None:
+            translated = await translate_chunks(group, source_lang, target_lang, user)
+        results.update(zip(group, translated))
+    return [results[sentence] for sentence in sentences]
+
+async def translate_text(text: str, source_lang: str, target_lang: str, user: Optional[int] = None) -> str:
+    # 複数行・長文は塊に分けて並列に翻訳し、訳と発音の組を順番につなげる
+    with metrics.stage("split"):
+        chunks = split_chunks(text)
+    if len(chunks) > 1:
+        return CHUNK_SEPARATOR.join(await translate_chunks(chunks, source_lang, target_lang, user))
+
+    key = cache.make_key(text, source_lang, target_lang, MODEL_NAME)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    # 短い1行のメッセージは近い時間に届いたものとまとめて翻訳する
+    if BATCH_WINDOW > 0 and "\n" not in text.strip() and len(text) <= BATCH_MAX_CHARS:
+        result = await _batcher.submit((source_lang, target_lang), text.strip())
+        if result is not None:
+            return result
+
+    payload = _build_payload(text, target_lang)
+
+    try:
+        with metrics.stage("generate"):
+            output = await _generate(payload, user)
+        with metrics.stage("postprocess"):
+            result = _post_process_output(output)
+        if result:
+            cache.set(key, result)
+        return result
+    except Exception as e:
+        return f"翻訳エラー: {e}"
+
+async def translate_text_stream(text: str, source_lang: str, target_lang: str,
+                                user: Optional[int] = None) -> AsyncIterator[str]:
+    """ストリーミング翻訳。トークンが届くたびにそれまでの生出力全体を返す。
+
+    最終的な整形（_post_process_output）は呼び出し側で行う。user は送信者のID（混雑時に公平に順番を回す）。
+    """
+    key = cache.make_key(text, source_lang, target_lang, MODEL_NAME)
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    payload = _build_payload(text, target_lang)
+    output = ""
+    final = {}
+    early_stop = False
+
     try:
-        response = requests.post(url, json=payload, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        return _post_process_output(data.get("response", ""))
+        # 途中で抜けたときにすぐ接続を閉じて、Ollama の生成を止める
+        async with aclosing(scheduler.generate_stream(payload, PRIORITY_TRANSLATE, user)) as stream:
+            async for chunk in stream:
+                if chunk.get("done"):
+                    final = chunk
+                token = chunk.get("response", "")
+                if token:
+                    output += token
+                    yield output
+                    # 訳と発音の2行がそろったら、残りは捨てるだけなので生成を止める
+                    if budget.translation_complete(output):
+                        early_stop = True
+                        break
+        if budget.observe(final, early_stop) and not budget.translation_complete(output):
+            output = await _generate({**payload, "options": budget.relaxed(payload["options"])}, user, False)
+            yield output
+        with metrics.stage("postprocess"):
+            result = _post_process_output(output)
+        if result:
+            cache.set(key, result)
     except Exception as e:
-        return f"翻訳エラー: {e}"
\ No newline at end of file
+        yield f"翻訳エラー: {e}"
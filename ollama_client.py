@@ -0,0 +1,223 @@
+import asyncio
+import json
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
+
+import aiohttp
+from settings import settings
+
+from backend_pool import Backend, BackendPool, parse_backends
+from metrics import metrics
+
+# Ollama APIのエンドポイント（1台の場合）
+url = settings.get("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+# 複数台の場合（例: "http://gpu0:11434=my-translator,gemma3:12b http://gpu1:11434=my-translator"）
+# 指定すると OLLAMA_API_URL より優先する
+BACKENDS = settings.get("OLLAMA_BACKENDS", "")
+# プールする keep-alive 接続の上限
+MAX_CONNECTIONS = settings.get_int("OLLAMA_MAX_CONNECTIONS", 8)
+# 1リクエストあたりのタイムアウト（秒）
+TIMEOUT = settings.get_float("OLLAMA_TIMEOUT", 60)
+# ヘルスチェックの間隔（秒）。0 なら行わない
+HEALTH_INTERVAL = settings.get_float("OLLAMA_HEALTH_INTERVAL", 15)
+# ヘルスチェック1回のタイムアウト（秒）
+HEALTH_TIMEOUT = 5.0
+
+# 翻訳とQ&Aで共有するセッション（イベントループ上で遅延生成）
+_session: Optional[aiohttp.ClientSession] = None
+_health_task: Optional[asyncio.Task] = None
+
+
+def configure(spec: str) -> None:
+    """接続先を設定し直す（ベンチマークなどから使う）。
+
+    spec は OLLAMA_BACKENDS と同じ形式か、/api/generate のURL。
+    """
+    global pool
+    pool = BackendPool(parse_backends(spec))
+
+
+# 接続先のサーバー群
+pool = BackendPool(parse_backends(BACKENDS) or [Backend(url)])
+
+
+def _pool_stats() -> dict:
+    # サーバーごとの値を項目ごとにまとめ直す（メトリクス用）
+    rows = pool.stats()
+    return {key: {row["url"]: row[key] for row in rows} for key in ("outstanding", "latency", "requests", "errors")}
+
+
+metrics.add_collector("backend", _pool_stats, label="backend")
+
+
+def get_session() -> aiohttp.ClientSession:
+    """共有セッションを取得（なければ作成）"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """共有セッションを閉じる（Bot終了時に呼ぶ）"""
+    global _session, _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        _health_task = None
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _is_backend_failure(error: BaseException) -> bool:
+    """サーバー側の問題か（他のサーバーで再試行する価値があるか）"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        # 4xx はリクエスト自体の問題なので、どのサーバーでも同じ結果になる
+        return not 400 <= error.status < 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def _acquire(model: str, tried: List[Backend], last_error: Optional[BaseException]) -> Backend:
+    try:
+        return pool.acquire(model, tried)
+    except RuntimeError:
+        if last_error is not None:
+            raise last_error
+        raise
+
+
+async def _post(backend: Backend, payload: dict) -> dict:
+    session = get_session()
+    async with session.post(f"{backend.base_url}/api/generate", json=payload) as response:
+        response.raise_for_status()
+        # Ollama は Content-Type を付けないことがあるので検査しない
+        return await response.json(content_type=None)
+
+
+async def generate(payload: dict, backend: Optional[Backend] = None) -> dict:
+    """/api/generate を非同期で呼び出し、レスポンスのJSONを返す。
+
+    backend を省略すると、モデルを扱えるサーバーのうち空いているものに送り、
+    接続エラーやサーバーエラーなら別のサーバーで再試行する。
+    """
+    if backend is not None:
+        return await _post(backend, payload)
+
+    model = payload.get("model", "")
+    tried: List[Backend] = []
+    last_error = None
+    while True:
+        backend = _acquire(model, tried, last_error)
+        start = time.monotonic()
+        ok = None
+        try:
+            result = await _post(backend, payload)
+            ok = True
+            return result
+        except Exception as e:
+            ok = not _is_backend_failure(e)
+            if ok:
+                raise
+            print(f"Ollama サーバー {backend.base_url} でエラー: {e!r}")
+            tried.append(backend)
+            last_error = e
+        finally:
+            pool.release(backend, time.monotonic() - start, ok)
+
+
+async def get_json(path: str, backend: Optional[Backend] = None) -> dict:
+    """/api/ps などの GET エンドポイントを呼ぶ（path は "/api/ps" の形式）"""
+    if backend is None:
+        backend = next((b for b in pool.backends if b.healthy), pool.backends[0])
+    session = get_session()
+    async with session.get(f"{backend.base_url}{path}") as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+async def _stream(backend: Backend, payload: dict) -> AsyncIterator[dict]:
+    session = get_session()
+    async with session.post(f"{backend.base_url}/api/generate", json={**payload, "stream": True}) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.strip()
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            yield chunk
+            if chunk.get("done"):
+                break
+
+
+async def generate_stream(payload: dict) -> AsyncIterator[dict]:
+    """/api/generate をストリーミングで呼び出し、NDJSON の各チャンクを順に返す。
+
+    最初のチャンクが届く前の失敗なら別のサーバーで再試行する（途中からはやり直さない）。
+    """
+    model = payload.get("model", "")
+    tried: List[Backend] = []
+    last_error = None
+    while True:
+        backend = _acquire(model, tried, last_error)
+        start = time.monotonic()
+        started = False
+        ok = None
+        try:
+            async with aclosing(_stream(backend, payload)) as stream:
+                async for chunk in stream:
+                    started = True
+                    yield chunk
+            ok = True
+            return
+        except Exception as e:
+            ok = not _is_backend_failure(e)
+            if ok or started:
+                raise
+            print(f"Ollama サーバー {backend.base_url} でエラー: {e!r}")
+            tried.append(backend)
+            last_error = e
+        finally:
+            pool.release(backend, time.monotonic() - start, ok)
+
+
+async def check_health() -> None:
+    """全サーバーの /api/tags を確認し、応答の有無と扱えるモデルを記録する"""
+    session = get_session()
+
+    async def check(backend: Backend) -> None:
+        try:
+            async with session.get(f"{backend.base_url}/api/tags",
+                                   timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+        except Exception:
+            pool.mark_health(backend, False)
+            return
+        models = {m.get("name") for m in data.get("models", []) if m.get("name")}
+        pool.mark_health(backend, True, models)
+
+    await asyncio.gather(*(check(backend) for backend in pool.backends))
+
+
+async def _health_loop() -> None:
+    while True:
+        await asyncio.sleep(HEALTH_INTERVAL)
+        try:
+            await check_health()
+        except Exception as e:
+            print(f"ヘルスチェックのエラー: {e}")
+
+
+async def start_health_checks() -> None:
+    """最初のヘルスチェックを行い、以降は定期的に確認する（複数回呼んでもよい）"""
+    global _health_task
+    await check_health()
+    if HEALTH_INTERVAL > 0 and (_health_task is None or _health_task.done()):
+        _health_task = asyncio.create_task(_health_loop())
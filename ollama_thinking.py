@@ -1,46 +1,99 @@
-import requests
+import asyncio
 import json
-import os
-from dotenv import load_dotenv
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
 
-# 環境変数の読み込み
-load_dotenv()
+import aiohttp
+from settings import settings
 
-# Ollama APIのエンドポイント
-url = os.getenv("OLLAMA_API_URL", "http://localhost:11434/api/generate")
+from generation_budget import budget
+from metrics import metrics
+from model_manager import manager
+from qa_sessions import MAX_CONTEXT_TOKENS, SessionKey, sessions
+from scheduler import PRIORITY_THINK, scheduler
 
-def think_text(text: str) -> str:
+MODEL_NAME = "gemma3:12b"
+
+# Q&A モデルのコンテキスト長（0 なら覚えておく会話の長さと出力数の上限から見積もる）
+NUM_CTX = settings.get_int("THINK_NUM_CTX", 0) or budget.think_context(MAX_CONTEXT_TOKENS)
+budget.set_context_size(MODEL_NAME, NUM_CTX)
+# 出力数の上限で回答が切れたときに付ける注記
+TRUNCATED_NOTE = "\n（回答が長いため途中までです）"
+
+def _build_payload(text: str, context: Optional[List[int]] = None) -> dict:
     prompt = (f"{text}")
 
     payload = {
-        "model": "gemma3:12b",
+        "model": MODEL_NAME,
         "prompt": prompt,
         "stream": False,
+        "keep_alive": manager.keep_alive(MODEL_NAME),
         "options": {
             "temperature": 0.7,
             "top_p": 0.9,
-            "num_predict": 1000,
             "enable_thinking": False,  # 推論モードを無効化
+            # 質問の長さに見合った出力数の上限（THINK_MAX_PREDICT まで）とコンテキスト長
+            **budget.think_options(MODEL_NAME, text),
         },
     }
+    # 前回までの会話（Ollama が返した context）があれば続きとして生成する
+    if context:
+        payload["context"] = context
+    return payload
 
-    try:
-        response = requests.post(url, json=payload, timeout=60)
-        response.raise_for_status()
+async def think_text(text: str, user: Optional[int] = None, session: Optional[SessionKey] = None) -> str:
+    """session を渡すと、そのキーの前回までの会話の続きとして答える"""
+    payload = _build_payload(text, sessions.get(session) if session else None)
 
-        data = response.json()
+    try:
+        with metrics.stage("generate"):
+            data = await scheduler.generate(payload, PRIORITY_THINK, user)
+        if session:
+            sessions.update(session, data.get("context"))
         raw = data.get("response", "")
         raw2 = data.get("thinking", "")
-        
+        if budget.observe(data):
+            raw += TRUNCATED_NOTE
+
         # print(f"thio: response data: {data}")  # デバッグ出力
         return raw
 
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"APIリクエストエラー: {e}")
         return f"翻訳エラー: {e}"
     except json.JSONDecodeError as e:
         print(f"JSON解析エラー: {e}")
-        return f"翻訳エラー: JSON解析失敗"
+        return "翻訳エラー: JSON解析失敗"
     except Exception as e:
         print(f"予期しないエラー: {e}")
         return f"翻訳エラー: {e}"
+
+async def think_text_stream(text: str, user: Optional[int] = None,
+                            session: Optional[SessionKey] = None) -> AsyncIterator[str]:
+    """ストリーミング版 think_text。トークンが届くたびにそれまでの出力全体を返す"""
+    payload = _build_payload(text, sessions.get(session) if session else None)
+    output = ""
+
+    try:
+        # 途中で抜けたときにすぐ接続を閉じて、Ollama の生成を止める
+        async with aclosing(scheduler.generate_stream(payload, PRIORITY_THINK, user)) as stream:
+            async for chunk in stream:
+                if chunk.get("done") and session:
+                    sessions.update(session, chunk.get("context"))
+                token = chunk.get("response", "")
+                if token:
+                    output += token
+                    yield output
+                if chunk.get("done") and budget.observe(chunk):
+                    output += TRUNCATED_NOTE
+                    yield output
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"APIリクエストエラー: {e}")
+        yield f"翻訳エラー: {e}"
+    except json.JSONDecodeError as e:
+        print(f"JSON解析エラー: {e}")
+        yield "翻訳エラー: JSON解析失敗"
+    except Exception as e:
+        print(f"予期しないエラー: {e}")
+        yield f"翻訳エラー: {e}"
@@ -0,0 +1,272 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Union
+
+import discord
+from settings import settings
+
+from metrics import metrics
+from rate_limiter import TokenBucket, parse_rate
+
+# チャンネルごとの送信・編集の回数（"回数/秒"。Discord の制限はチャンネルあたり5回/5秒程度）
+RATE = settings.get("OUTBOUND_RATE", "5/5")
+# Discord のメッセージ文字数上限
+MESSAGE_LIMIT = 2000
+# まとめて送るときの区切り
+MERGE_SEPARATOR = "\n\n"
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """limit 文字以下になるように、段落・行の区切りで分ける（1行が長すぎる場合はその中で切る）"""
+    parts = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            parts.append(current)
+            current = line
+    if current.strip():
+        parts.append(current)
+    return [part.strip("\n") for part in parts if part.strip()]
+
+
+def _retrieve(future: asyncio.Future) -> None:
+    # 結果を待たない送信の例外で「never retrieved」の警告を出さない（エラーは送信側で表示済み）
+    if not future.cancelled():
+        future.exception()
+
+
+class _Send:
+    __slots__ = ("channel", "text", "group", "futures", "queued")
+
+    def __init__(self, channel: discord.abc.Messageable, text: str, group: Optional[str], future: asyncio.Future):
+        self.channel = channel
+        self.text = text
+        self.group = group
+        self.futures = [future]
+        self.queued = time.monotonic()
+
+
+class _Edit:
+    __slots__ = ("message", "content", "progress", "futures", "queued")
+
+    def __init__(self, message: discord.Message, content: str, progress: bool):
+        self.message = message
+        self.content = content
+        self.progress = progress
+        self.futures: List[asyncio.Future] = []
+        self.queued = time.monotonic()
+
+
+class ChannelSender:
+    """1つのチャンネルへの送信・編集を順番に、レート制限の範囲で行う。
+
+    制限で待たされている間にたまった同じ group の短いメッセージは1通にまとめ、
+    同じメッセージへの編集は最新の内容だけを送る。
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, capacity: float, rate: float):
+        self.channel = channel
+        self.bucket = TokenBucket(capacity, rate, time.monotonic())
+        self.queue: Deque[Union[_Send, _Edit]] = deque()
+        # メッセージID -> まだ送っていない編集
+        self._edits: Dict[int, _Edit] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.edited = 0
+        self.merged = 0
+        self.dropped_edits = 0
+        self.split = 0
+        # 予約してから送り始めるまでの時間
+        self.delivered = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    @property
+    def busy(self) -> bool:
+        """送信待ちがある、または制限に達している"""
+        self.bucket.refill(time.monotonic())
+        return bool(self.queue) or self.bucket.tokens < 1
+
+    def post(self, text: str, group: Optional[str] = None,
+             channel: Optional[discord.abc.Messageable] = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        self.queue.append(_Send(channel or self.channel, text, group, future))
+        self._start()
+        return future
+
+    def edit(self, message: discord.Message, content: str, progress: bool = False) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        pending = self._edits.get(message.id)
+        if pending is not None:
+            # まだ送っていない編集は内容だけ差し替える（途中経過の編集は最新のものだけでよい）
+            self.dropped_edits += 1
+            pending.content = content
+            pending.progress = pending.progress and progress
+        else:
+            pending = self._edits[message.id] = _Edit(message, content, progress)
+            self.queue.append(pending)
+        pending.futures.append(future)
+        self._start()
+        return future
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _take(self) -> None:
+        while True:
+            self.bucket.refill(time.monotonic())
+            wait = self.bucket.wait_time(1)
+            if wait <= 0:
+                self.bucket.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    async def _run(self) -> None:
+        while self.queue:
+            await self._take()
+            item = self.queue.popleft()
+            if isinstance(item, _Edit):
+                self._edits.pop(item.message.id, None)
+                send = self._send_edit(item)
+            else:
+                send = self._send_text(item.channel, self._merge(item))
+            futures = item.futures
+            delay = time.monotonic() - item.queued
+            self.delivered += 1
+            self.delay_total += delay
+            self.delay_max = max(self.delay_max, delay)
+            try:
+                result = await send
+            except Exception as e:
+                print(f"メッセージの送信エラー ({getattr(self.channel, 'id', '?')}): {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
+
+    def _merge(self, item: _Send) -> str:
+        text = item.text
+        if item.group is None:
+            return text
+        # 次の1通をすぐ送れる間はまとめない
+        self.bucket.refill(time.monotonic())
+        while self.queue and self.bucket.tokens < 1:
+            following = self.queue[0]
+            if not isinstance(following, _Send) or following.group != item.group:
+                break
+            if len(text) + len(MERGE_SEPARATOR) + len(following.text) > MESSAGE_LIMIT:
+                break
+            self.queue.popleft()
+            text += MERGE_SEPARATOR + following.text
+            item.futures.extend(following.futures)
+            self.merged += 1
+        return text
+
+    async def _send_text(self, channel: discord.abc.Messageable, text: str) -> discord.Message:
+        """長すぎる場合は分けて送り、最後のメッセージを返す"""
+        parts = split_message(text) or [text]
+        if len(parts) > 1:
+            self.split += 1
+        message = None
+        for i, part in enumerate(parts):
+            if i:
+                await self._take()
+            message = await channel.send(part)
+            self.sent += 1
+        return message
+
+    async def _send_edit(self, item: _Edit) -> discord.Message:
+        if item.progress:
+            # 途中経過は入りきる分だけ表示する
+            await item.message.edit(content=item.content[:MESSAGE_LIMIT])
+            self.edited += 1
+            return item.message
+        parts = split_message(item.content) or [item.content]
+        await item.message.edit(content=parts[0])
+        self.edited += 1
+        if len(parts) > 1:
+            # 入りきらない分は続けて新しいメッセージで送る
+            self.split += 1
+            await self._take()
+            await self._send_text(item.message.channel, "\n".join(parts[1:]))
+        return item.message
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "sent": self.sent,
+            "edited": self.edited,
+            "merged": self.merged,
+            "dropped_edits": self.dropped_edits,
+            "split": self.split,
+            "delivered": self.delivered,
+            "delay_total": self.delay_total,
+            "delay_max": self.delay_max,
+        }
+
+
+class Outbox:
+    """チャンネルごとの ChannelSender をまとめる"""
+
+    def __init__(self, rate: str = RATE):
+        # "0" なら待たずに送る（discord.py 自体のレート制限の処理だけになる）
+        self.capacity, self.rate = parse_rate(rate) or (1e9, 1e9)
+        self.senders: Dict[int, ChannelSender] = {}
+
+    def sender(self, channel: discord.abc.Messageable) -> ChannelSender:
+        """channel.id ごとの ChannelSender（送信は予約したときのチャンネルのオブジェクトに送る）"""
+        sender = self.senders.get(channel.id)
+        if sender is None:
+            sender = self.senders[channel.id] = ChannelSender(channel, self.capacity, self.rate)
+        else:
+            sender.channel = channel
+        return sender
+
+    def busy(self, channel: discord.abc.Messageable) -> bool:
+        return self.sender(channel).busy
+
+    def post(self, channel: discord.abc.Messageable, text: str, group: Optional[str] = None) -> asyncio.Future:
+        """送信を予約する（結果を待たない。group が同じ短いメッセージは混雑時に1通にまとめる）"""
+        return self.sender(channel).post(text, group, channel)
+
+    async def send(self, channel: discord.abc.Messageable, text: str, group: Optional[str] = None) -> discord.Message:
+        """送信して、送ったメッセージ（分けた場合は最後のもの）を返す"""
+        with metrics.stage("send"):
+            return await self.post(channel, text, group)
+
+    def edit(self, message: discord.Message, content: str, progress: bool = False) -> asyncio.Future:
+        """編集を予約する。progress=True の途中経過は長ければ切り詰め、後の編集があれば送らない"""
+        return self.sender(message.channel).edit(message, content, progress)
+
+    def stats(self) -> dict:
+        total: Dict[str, float] = {"delay_max": 0.0}
+        for sender in self.senders.values():
+            for key, value in sender.stats().items():
+                if key == "delay_max":
+                    total[key] = max(total[key], value)
+                else:
+                    total[key] = total.get(key, 0) + value
+        delivered = total.pop("delivered", 0)
+        total["delay_avg"] = total.pop("delay_total", 0.0) / delivered if delivered else 0.0
+        return total
+
+
+# Bot 全体で共有する送信キュー
+outbox = Outbox()
+metrics.add_collector("outbound", outbox.stats)
@@ -0,0 +1,73 @@
+import re
+from typing import Optional
+
+from metrics import metrics
+from translation_cache import normalize_text
+import utils
+
+# 翻訳に不要な部分（コードブロック・インラインコード・URL・メンション・カスタム絵文字・タイムスタンプ）
+RE_STRIP = re.compile(
+    r"```.*?```|`[^`\n]*`|https?://\S+|<a?:\w+:\d+>|<[@#][!&]?\d+>|<t:\d+(?::\w)?>",
+    re.DOTALL,
+)
+# 笑い・相づちだけのメッセージ（www, 草, ㅋㅋ, ㅎㅎ, ㅠㅠ など）
+RE_TRIVIAL = re.compile(r"[wWｗＷ草ㅋㅎㅠㅜ\s!！?？~〜～.。、…・ー\-]+")
+# 辞書引きの前に落とす末尾の記号
+TRAILING_PUNCT = "!！?？~〜～.。…♪ "
+
+# よく使う短いフレーズはモデルを使わずに返す（Modelfile と同じ2行フォーマット）
+PHRASES = {
+    ("ja", "ko"): {
+        "おはよう": "안녕\n発音: アンニョン",
+        "おはようございます": "안녕하세요\n発音: アンニョンハセヨ",
+        "こんにちは": "안녕하세요\n発音: アンニョンハセヨ",
+        "こんばんは": "안녕하세요\n発音: アンニョンハセヨ",
+        "ありがとう": "고마워\n発音: コマウォ",
+        "ありがとうございます": "감사합니다\n発音: カムサハムニダ",
+        "おやすみ": "잘 자\n発音: チャル ジャ",
+        "おやすみなさい": "안녕히 주무세요\n発音: アンニョンヒ ジュムセヨ",
+        "おつかれ": "수고했어\n発音: スゴヘッソ",
+        "お疲れ様です": "수고하셨습니다\n発音: スゴハショッスムニダ",
+        "はい": "네\n発音: ネ",
+        "うん": "응\n発音: ウン",
+        "ごめん": "미안\n発音: ミアン",
+        "ごめんなさい": "미안해요\n発音: ミアネヨ",
+    },
+    ("ko", "ja"): {
+        "안녕": "やあ\n発音: 야아",
+        "안녕하세요": "こんにちは\n発音: 곤니치와",
+        "고마워": "ありがとう\n発音: 아리가토",
+        "고마워요": "ありがとうございます\n発音: 아리가토 고자이마스",
+        "감사합니다": "ありがとうございます\n発音: 아리가토 고자이마스",
+        "잘 자": "おやすみ\n発音: 오야스미",
+        "잘자": "おやすみ\n発音: 오야스미",
+        "수고했어": "おつかれ\n発音: 오츠카레",
+        "수고하셨습니다": "お疲れ様です\n発音: 오츠카레사마데스",
+        "네": "はい\n発音: 하이",
+        "응": "うん\n発音: 운",
+        "미안": "ごめん\n発音: 고멘",
+        "미안해요": "ごめんなさい\n発音: 고멘나사이",
+    },
+}
+
+# モデルを使わずに済んだ件数
+stats = {"skipped": 0, "phrase_hits": 0}
+metrics.add_collector("prefilter", lambda: stats)
+
+
+def clean_text(text: str) -> str:
+    """翻訳に不要な部分を取り除く"""
+    return RE_STRIP.sub(" ", text).strip()
+
+
+def is_trivial(text: str) -> bool:
+    """翻訳する意味がないメッセージか（空・笑いや記号だけ・絵文字や数字だけ）"""
+    if not text or RE_TRIVIAL.fullmatch(text):
+        return True
+    return sum(utils.count_scripts(text).values()) == 0
+
+
+def lookup_phrase(text: str, source_lang: str, target_lang: str) -> Optional[str]:
+    """定番フレーズならその訳を返す"""
+    key = normalize_text(text).rstrip(TRAILING_PUNCT)
+    return PHRASES.get((source_lang, target_lang), {}).get(key)
@@ -0,0 +1,104 @@
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from settings import settings
+
+from metrics import metrics
+
+# 最後の質問からこの秒数が過ぎた会話は忘れる
+SESSION_TTL = settings.get_float("QA_SESSION_TTL", 600)
+# 同時に覚えておく会話の数（超えたら最後に使われたのが古いものから忘れる）
+MAX_SESSIONS = settings.get_int("QA_SESSION_MAX", 200)
+# 1つの会話で覚えておく最大トークン数（超えたら会話をやり直す）
+MAX_CONTEXT_TOKENS = settings.get_int("QA_CONTEXT_MAX_TOKENS", 2048)
+
+SessionKey = Tuple[int, int]
+
+
+class Session:
+    __slots__ = ("context", "turns", "updated")
+
+    def __init__(self, context: array, turns: int, updated: float):
+        # Ollama が返した context（トークン列）。int のリストより小さい array で持つ
+        self.context = context
+        self.turns = turns
+        self.updated = updated
+
+
+class SessionStore:
+    """チャンネル・ユーザーごとの Q&A の会話（Ollama の context）を保持する。
+
+    次の質問で context を送ると、前回までのやり取りを文字列で送り直さずに続きから生成できる。
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = MAX_SESSIONS,
+                 max_tokens: int = MAX_CONTEXT_TOKENS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self._sessions: "OrderedDict[SessionKey, Session]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.overflowed = 0
+
+    def get(self, key: SessionKey) -> Optional[List[int]]:
+        """続きの会話があれば context を返す"""
+        session = self._sessions.get(key)
+        if session is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - session.updated > self.ttl:
+            del self._sessions[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._sessions.move_to_end(key)
+        self.hits += 1
+        return session.context.tolist()
+
+    def update(self, key: SessionKey, context: Optional[List[int]]) -> None:
+        """生成後に返ってきた context を保存する（長くなりすぎたら会話を終える）"""
+        if not context:
+            return
+        if len(context) > self.max_tokens:
+            self._sessions.pop(key, None)
+            self.overflowed += 1
+            return
+
+        previous = self._sessions.pop(key, None)
+        turns = previous.turns + 1 if previous else 1
+        self._sessions[key] = Session(array("i", context), turns, time.monotonic())
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        # 古い方から期限切れのものを捨てる
+        now = time.monotonic()
+        while self._sessions:
+            oldest_key, oldest = next(iter(self._sessions.items()))
+            if now - oldest.updated <= self.ttl:
+                break
+            del self._sessions[oldest_key]
+            self.expired += 1
+
+    def reset(self, key: SessionKey) -> bool:
+        return self._sessions.pop(key, None) is not None
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "tokens": sum(len(s.context) for s in self._sessions.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "overflowed": self.overflowed,
+        }
+
+
+# Bot 全体で共有する会話
+sessions = SessionStore()
+metrics.add_collector("qa_sessions", sessions.stats)
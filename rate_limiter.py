@@ -0,0 +1,127 @@
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from settings import settings
+
+from metrics import metrics
+
+# "回数/秒" の形式（例: "8/30" は30秒に8回まで、連続8回まで可）。空または 0 で無効
+LIMITS = {
+    ("translate", "user"): settings.get("RATE_LIMIT_TRANSLATE_USER", "8/30"),
+    ("translate", "channel"): settings.get("RATE_LIMIT_TRANSLATE_CHANNEL", "40/60"),
+    ("think", "user"): settings.get("RATE_LIMIT_THINK_USER", "3/60"),
+    ("think", "channel"): settings.get("RATE_LIMIT_THINK_CHANNEL", "10/60"),
+}
+# この文字数ごとに1回分多く消費する（長文の貼り付け対策）
+COST_CHARS = settings.get_int("RATE_LIMIT_COST_CHARS", 500)
+# 保持するバケット数がこれを超えたら満タンのものを捨てる
+MAX_BUCKETS = 10000
+
+
+def parse_rate(spec: str) -> Optional[Tuple[float, float]]:
+    """"8/30" -> (容量 8, 毎秒 8/30 回復)"""
+    spec = spec.strip()
+    if not spec or spec == "0":
+        return None
+    count, period = spec.split("/", 1)
+    return float(count), float(count) / float(period)
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """cost 分たまるまでの秒数（0 ならすぐ使える）"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    retry_after: float  # 次に送れるまでの秒数
+    notify: bool        # 制限にかかったことをまだ知らせていないか（2回目以降は軽い反応だけにする）
+
+
+class RateLimiter:
+    """ユーザーごと・チャンネルごとのトークンバケット。翻訳と Q&A で別々の制限を持つ"""
+
+    def __init__(self, limits: Dict[Tuple[str, str], str], cost_chars: int = COST_CHARS):
+        self.rates = {key: rate for key, spec in limits.items() if (rate := parse_rate(spec))}
+        self.cost_chars = cost_chars
+        self._buckets: Dict[tuple, TokenBucket] = {}
+        # 制限中であることを知らせた相手と、その制限が解けるまでの時刻
+        self._notified: Dict[tuple, float] = {}
+        self.allowed = 0
+        self.rejected = 0
+
+    def cost(self, text: str) -> float:
+        return 1 + (len(text) // self.cost_chars if self.cost_chars else 0)
+
+    def _bucket(self, kind: str, scope: str, ident: int, now: float) -> Optional[TokenBucket]:
+        rate = self.rates.get((kind, scope))
+        if rate is None:
+            return None
+        key = (kind, scope, ident)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(rate[0], rate[1], now)
+        bucket.refill(now)
+        return bucket
+
+    def check(self, kind: str, user_id: int, channel_id: int, text: str = "") -> Decision:
+        """ユーザーとチャンネルの両方に余裕があれば消費して許可する"""
+        now = time.monotonic()
+        buckets = [
+            bucket for bucket in (
+                self._bucket(kind, "user", user_id, now),
+                self._bucket(kind, "channel", channel_id, now),
+            ) if bucket is not None
+        ]
+        # 容量を超える長文でも、満タンまで待てば送れるようにする
+        cost = self.cost(text)
+        wait = max((bucket.wait_time(min(cost, bucket.capacity)) for bucket in buckets), default=0.0)
+        if wait > 0:
+            self.rejected += 1
+            key = (kind, user_id)
+            notify = self._notified.get(key, 0.0) <= now
+            if notify:
+                if len(self._notified) >= MAX_BUCKETS:
+                    self._prune(now)
+                self._notified[key] = now + wait
+            return Decision(False, wait, notify)
+
+        for bucket in buckets:
+            bucket.tokens -= min(cost, bucket.capacity)
+        self.allowed += 1
+        return Decision(True, 0.0, False)
+
+    def _prune(self, now: float) -> None:
+        # 満タンのバケットは新しく作るのと同じなので捨ててよい
+        full = []
+        for key, bucket in self._buckets.items():
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                full.append(key)
+        for key in full:
+            del self._buckets[key]
+        for key in [k for k, until in self._notified.items() if until <= now]:
+            del self._notified[key]
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "rejected": self.rejected, "buckets": len(self._buckets)}
+
+
+# Bot 全体で共有するレート制限
+limiter = RateLimiter(LIMITS)
+metrics.add_collector("rate_limit", limiter.stats)
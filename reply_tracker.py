@@ -0,0 +1,142 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from settings import settings
+
+from metrics import metrics
+
+# 編集に追従するために覚えておく翻訳の数（超えたら古いものから忘れる）
+MAX_TRACKED = settings.get_int("EDIT_TRACK_MAX", 500)
+# 送信からこの秒数が過ぎたメッセージの編集には追従しない
+TRACK_TTL = settings.get_float("EDIT_TRACK_TTL", 3600)
+# 続けて編集されたときは、最後の編集からこの秒数待ってから翻訳し直す
+DEBOUNCE = settings.get_float("EDIT_DEBOUNCE", 1.5)
+# 翻訳に失敗したときの出力（ollama.translate_text）。再利用しない
+ERROR_PREFIX = "翻訳エラー"
+
+
+class TrackedReply:
+    __slots__ = ("reply_id", "source_lang", "target_lang", "segments", "created")
+
+    def __init__(self, reply_id: int, source_lang: str, target_lang: str,
+                 segments: Dict[str, str], created: float):
+        self.reply_id = reply_id
+        self.source_lang = source_lang
+        self.target_lang = target_lang
+        # 翻訳した塊・文 -> その訳
+        self.segments = segments
+        self.created = created
+
+
+class ReplyTracker:
+    """翻訳したメッセージと返信の対応を覚えておき、元のメッセージの編集に追従する。
+
+    編集されたら塊ごとに前回と比べ、変わった塊はさらに文に分けて、前回と違う文だけを翻訳し直す。
+    """
+
+    def __init__(self, max_tracked: int = MAX_TRACKED, ttl: float = TRACK_TTL, debounce: float = DEBOUNCE):
+        self.max_tracked = max_tracked
+        self.ttl = ttl
+        self.debounce = debounce
+        self._replies: "OrderedDict[int, TrackedReply]" = OrderedDict()
+        # メッセージID -> 待ち合わせ中の翻訳し直し
+        self._pending: Dict[int, asyncio.Task] = {}
+        self.edits = 0
+        self.updated = 0
+        self.retranslated = 0
+        self.reused = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def track(self, message_id: int, reply_id: int, source_lang: str, target_lang: str,
+              translated: Dict[str, str]) -> None:
+        """translated は塊（または文） -> 訳。失敗した訳は覚えない"""
+        segments = {
+            text: result for text, result in translated.items()
+            if result and not result.startswith(ERROR_PREFIX)
+        }
+        previous = self._replies.pop(message_id, None)
+        created = previous.created if previous else time.monotonic()
+        self._replies[message_id] = TrackedReply(reply_id, source_lang, target_lang, segments, created)
+        while len(self._replies) > self.max_tracked:
+            self._replies.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, message_id: int) -> Optional[TrackedReply]:
+        entry = self._replies.get(message_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            del self._replies[message_id]
+            self.expired += 1
+            return None
+        return entry
+
+    def forget(self, message_id: int) -> None:
+        self._replies.pop(message_id, None)
+        task = self._pending.pop(message_id, None)
+        # 翻訳し直しの中から呼ばれた場合は自分自身を取り消さない
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+
+    def plan(self, entry: TrackedReply, chunks: List[str], split: Callable[[str], List[str]],
+             source_lang: str, target_lang: str) -> Tuple[Dict[str, str], List[str]]:
+        """前回の訳のうち使えるもの（塊・文 -> 訳）と、翻訳し直す文（重複なし）を返す。
+
+        前回と同じ塊はその訳を使い、違う塊は split で文に分けて文ごとに探す。
+        """
+        known = entry.segments if (entry.source_lang, entry.target_lang) == (source_lang, target_lang) else {}
+        reusable = {}
+        changed = []
+        for chunk in chunks:
+            if chunk in known:
+                reusable[chunk] = known[chunk]
+                continue
+            for sentence in split(chunk):
+                if sentence in known:
+                    reusable[sentence] = known[sentence]
+                elif sentence not in changed:
+                    changed.append(sentence)
+        self.reused += len(reusable)
+        self.retranslated += len(changed)
+        return reusable, changed
+
+    def schedule(self, message_id: int, job: Callable[[], Awaitable[None]]) -> None:
+        """debounce 秒待ってから job を実行する（その間に次の編集が来たら前の分は取り消す）"""
+        self.edits += 1
+        previous = self._pending.pop(message_id, None)
+        if previous is not None:
+            previous.cancel()
+        self._pending[message_id] = asyncio.create_task(self._run_later(message_id, job))
+
+    async def _run_later(self, message_id: int, job: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await asyncio.sleep(self.debounce)
+            await job()
+            self.updated += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"編集後の翻訳エラー: {e}")
+        finally:
+            if self._pending.get(message_id) is asyncio.current_task():
+                del self._pending[message_id]
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self._replies),
+            "pending": len(self._pending),
+            "edits": self.edits,
+            "updated": self.updated,
+            "retranslated": self.retranslated,
+            "reused": self.reused,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+# Bot 全体で共有する返信の対応表
+replies = ReplyTracker()
+metrics.add_collector("edits", replies.stats)
@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, Hashable, List
+
+from settings import settings
+
+import ollama_client
+from metrics import metrics
+from model_manager import manager
+
+# 優先度（小さいほど先に処理される）
+PRIORITY_TRANSLATE = 0
+PRIORITY_THINK = 10
+
+# モデルごとの同時生成数の既定値（Ollama サーバー1台あたり。台数分だけ増える）
+MAX_IN_FLIGHT = settings.get_int("SCHEDULER_MAX_IN_FLIGHT", 2)
+# モデル別の上書き（例: "my-translator=2,gemma3:12b=1"）
+MODEL_LIMITS = settings.get("SCHEDULER_MODEL_LIMITS", "")
+# 全モデル合計の同時生成数（サーバー1台あたり。同じGPUを取り合うので、ここで優先度が効く）
+MAX_TOTAL = settings.get_int("SCHEDULER_MAX_TOTAL", 2)
+# ユーザーごとの順番を覚えておく人数の上限
+MAX_TRACKED_USERS = 10000
+
+
+def _parse_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            model, limit = item.rsplit("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+class _SharedStream:
+    """同一プロンプトのストリームを複数の待ち手で共有するためのバッファ"""
+
+    def __init__(self):
+        self.chunks: List[dict] = []
+        self.done = False
+        self.error = None
+        # 最初の呼び出し側が途中で読むのをやめた（必要な分がそろった）
+        self.stopped = False
+        self.changed = asyncio.Event()
+
+    def push(self, chunk: dict) -> None:
+        self.chunks.append(chunk)
+        self.changed.set()
+
+    def finish(self, error=None) -> None:
+        self.done = True
+        self.error = error
+        self.changed.set()
+
+
+class InferenceScheduler:
+    """Ollama へのリクエストを優先度付きキューで流し、モデルごと・全体の同時生成数を制限する。
+
+    同じ優先度の中ではユーザーごとのラウンドロビンで順番を決める（連投した人の後ろに他の人が割り込める）。
+    同じペイロードのリクエストが処理中なら新たに生成せず、その結果を待つ（コアレッシング）。
+    """
+
+    def __init__(self, default_limit: int = MAX_IN_FLIGHT, limits: Dict[str, int] = None,
+                 max_total: int = MAX_TOTAL):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.max_total = max_total
+        self._active: Dict[str, int] = {}
+        self._total = 0
+        self._waiters: list = []
+        self._seq = itertools.count()
+        # ラウンドロビンの現在の周回と、ユーザーごとに最後に割り当てた周回
+        self._round = 0
+        self._user_rounds: Dict[Hashable, int] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, _SharedStream] = {}
+        # メトリクス
+        self.completed = 0
+        self.coalesced = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _has_capacity(self, model: str) -> bool:
+        # 上限はサーバー1台あたりなので、使えるサーバーの台数を掛ける
+        servers = max(1, ollama_client.pool.capacity(model))
+        limit = self.limits.get(model, self.default_limit) * servers
+        total = self.max_total * max(1, ollama_client.pool.capacity())
+        return self._active.get(model, 0) < limit and self._total < total
+
+    def _grant(self, model: str) -> None:
+        self._active[model] = self._active.get(model, 0) + 1
+        self._total += 1
+
+    def _next_round(self, user: Hashable) -> int:
+        """ユーザーの次の周回（待っている件数が多い人ほど後ろの周回になる）"""
+        if len(self._user_rounds) >= MAX_TRACKED_USERS:
+            # 現在の周回より前のユーザーは覚えていなくても同じ結果になる
+            self._user_rounds = {u: r for u, r in self._user_rounds.items() if r > self._round}
+        turn = max(self._round, self._user_rounds.get(user, 0) + 1)
+        self._user_rounds[user] = turn
+        return turn
+
+    async def _acquire(self, model: str, priority: int, user: Hashable = None) -> None:
+        start = time.monotonic()
+        turn = self._next_round(user)
+        if self._has_capacity(model):
+            self._grant(model)
+            self._round = max(self._round, turn)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, turn, next(self._seq), model, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # 枠を割り当てられた直後にキャンセルされた場合は返却する
+                if future.done() and not future.cancelled():
+                    self._release(model)
+                raise
+        waited = time.monotonic() - start
+        metrics.record_stage("queue", waited)
+        self.wait_count += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def _release(self, model: str) -> None:
+        self._active[model] -= 1
+        self._total -= 1
+        # 空いた枠を優先度・周回順に、枠のあるモデルの待ち手へ割り当てる
+        remaining = []
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            _, turn, _, model, future = entry
+            if future.done():
+                continue
+            if self._has_capacity(model):
+                self._grant(model)
+                self._round = max(self._round, turn)
+                future.set_result(None)
+            else:
+                remaining.append(entry)
+        for entry in remaining:
+            heapq.heappush(self._waiters, entry)
+
+    async def generate(self, payload: dict, priority: int = PRIORITY_TRANSLATE, user: Hashable = None) -> dict:
+        """ollama_client.generate をスケジューラ経由で呼ぶ（user は公平に順番を回すための識別子）"""
+        key = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        model = payload.get("model", "")
+        try:
+            await self._acquire(model, priority, user)
+            try:
+                result = await ollama_client.generate(payload)
+                manager.observe(model, result)
+                metrics.observe_generation(model, result)
+            finally:
+                self._release(model)
+                self.completed += 1
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError("共有中の生成がキャンセルされました")
+            future.set_exception(e)
+            # 待ち手がいない場合の "exception was never retrieved" を防ぐ
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def generate_stream(self, payload: dict, priority: int = PRIORITY_TRANSLATE,
+                              user: Hashable = None) -> AsyncIterator[dict]:
+        """ollama_client.generate_stream をスケジューラ経由で呼ぶ"""
+        key = json.dumps({**payload, "stream": True}, sort_keys=True, ensure_ascii=False)
+        shared = self._streams.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            async for chunk in self._follow(shared):
+                yield chunk
+            return
+
+        shared = _SharedStream()
+        self._streams[key] = shared
+        model = payload.get("model", "")
+        error = None
+        try:
+            await self._acquire(model, priority, user)
+            try:
+                # 途中で抜けたら接続をすぐ閉じて Ollama の生成を止める
+                async with aclosing(ollama_client.generate_stream(payload)) as stream:
+                    async for chunk in stream:
+                        if chunk.get("done"):
+                            manager.observe(model, chunk)
+                            metrics.observe_generation(model, chunk)
+                        shared.push(chunk)
+                        yield chunk
+            finally:
+                self._release(model)
+                self.completed += 1
+        except GeneratorExit:
+            # 同じペイロードに相乗りしている側も、そこまでの出力で終える
+            shared.stopped = True
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._streams.pop(key, None)
+            shared.finish(error)
+
+    async def _follow(self, shared: _SharedStream) -> AsyncIterator[dict]:
+        index = 0
+        while True:
+            while index < len(shared.chunks):
+                yield shared.chunks[index]
+                index += 1
+            if shared.done:
+                if shared.stopped:
+                    return
+                if shared.error is not None:
+                    raise RuntimeError(f"共有中の生成が失敗しました: {shared.error}")
+                if not shared.chunks or not shared.chunks[-1].get("done"):
+                    raise RuntimeError("共有中の生成が途中で終了しました")
+                return
+            shared.changed.clear()
+            await shared.changed.wait()
+
+    def stats(self) -> dict:
+        queued: Dict[str, int] = {}
+        for _, _, _, model, future in self._waiters:
+            if not future.done():
+                queued[model] = queued.get(model, 0) + 1
+        return {
+            "active": dict(self._active),
+            "queued": queued,
+            "completed": self.completed,
+            "coalesced": self.coalesced,
+            "wait_avg": self.wait_total / self.wait_count if self.wait_count else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+# Bot 全体で共有するスケジューラ
+scheduler = InferenceScheduler(limits=_parse_limits(MODEL_LIMITS))
+metrics.add_collector("scheduler", scheduler.stats, label="model")
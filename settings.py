@@ -0,0 +1,35 @@
+import os
+from typing import Optional
+
+from dotenv import load_dotenv
+
+
+class Settings:
+    """.env と環境変数から設定を読む。.env の読み込みは最初に参照されたときの1回だけ行う"""
+
+    def __init__(self):
+        self._loaded = False
+
+    def _load(self) -> None:
+        if not self._loaded:
+            # 既に設定されている環境変数は上書きしない
+            load_dotenv()
+            self._loaded = True
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        self._load()
+        return os.environ.get(name, default)
+
+    def get_int(self, name: str, default: int) -> int:
+        return int(self.get(name, str(default)))
+
+    def get_float(self, name: str, default: float) -> float:
+        return float(self.get(name, str(default)))
+
+    def get_bool(self, name: str, default: bool) -> bool:
+        # "1" のときだけ有効（STREAM_REPLIES=0 などで無効にする）
+        return self.get(name, "1" if default else "0") == "1"
+
+
+# 全モジュールで共有する設定
+settings = Settings()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""起動時間の計測（import の内訳と on_ready までの時間）
+
+    python startup.py          # main を import したときの内訳を表示
+    python startup.py --json   # JSON で出力（前回の結果と比べる用）
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# このモジュールが import された時刻（main.py で最初に import する）
+STARTED = time.perf_counter()
+# 起動時に読み込まれていてほしくない重いモジュール（初回の音楽コマンドで読み込む）
+LAZY_MODULES = ("vc_music", "yt_dlp")
+
+_imports: List[Tuple[str, float]] = []
+_ready: Optional[float] = None
+
+
+@contextmanager
+def measure(name: str):
+    """with の中の import にかかった時間を記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name: str, elapsed: float) -> None:
+    _imports.append((name, elapsed))
+
+
+def mark_ready() -> bool:
+    """最初の on_ready の時刻を記録する（再接続時の on_ready は数えない）"""
+    global _ready
+    if _ready is not None:
+        return False
+    _ready = time.perf_counter() - STARTED
+    return True
+
+
+def report() -> str:
+    lines = ["**起動時間**"]
+    for name, elapsed in _imports:
+        lines.append(f"- import {name}: {elapsed * 1000:.0f}ms")
+    if _ready is not None:
+        lines.append(f"- on_ready まで: {_ready:.2f}秒")
+    loaded = [name for name in LAZY_MODULES if name in sys.modules]
+    lines.append(f"- 読み込み済みの音楽モジュール: {', '.join(loaded) if loaded else 'なし'}")
+    return "\n".join(lines)
+
+
+def import_breakdown(module: str = "main") -> Dict:
+    """別プロセスで -X importtime を使い、module が直接 import しているものごとの時間を調べる"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # 出力は子が先・親が後の順なので、深さ1の行を親（深さ0）が出るまでためておく
+    pending = []
+    children = []
+    total = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # 見出し行
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        modules.add(name.split(".", 1)[0])
+        if depth == 0:
+            if name == module:
+                total = int(cumulative)
+                children = pending
+            pending = []
+        elif depth == 1:
+            pending.append((name, int(cumulative)))
+
+    children.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "total_ms": total / 1000,
+        "imports": [{"module": name, "ms": us / 1000} for name, us in children],
+        "lazy_loaded": [name for name in LAZY_MODULES if name in modules],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bot の起動時の import 時間を調べる")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--top", type=int, default=15, help="表示する件数")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    breakdown = import_breakdown(args.module)
+    if args.json:
+        print(json.dumps(breakdown, ensure_ascii=False, indent=2))
+        return
+
+    print(f"import {args.module}: {breakdown['total_ms']:.0f}ms")
+    for item in breakdown["imports"][:args.top]:
+        print(f"  {item['ms']:8.1f}ms  {item['module']}")
+    if breakdown["lazy_loaded"]:
+        print(f"警告: 起動時に {', '.join(breakdown['lazy_loaded'])} が読み込まれています")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from settings import settings
+
+from metrics import metrics
+
+# メモリ上に保持する最大件数（LRUで追い出す）
+CACHE_SIZE = settings.get_int("TRANSLATION_CACHE_SIZE", 1000)
+# キャッシュの有効期限（秒）
+CACHE_TTL = settings.get_float("TRANSLATION_CACHE_TTL", 7 * 24 * 3600)
+# SQLite の保存先（空ならメモリのみ）
+CACHE_DB = settings.get("TRANSLATION_CACHE_DB", "")
+
+MODELFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Modelfile")
+
+
+def _modelfile_hash() -> str:
+    """Modelfile の内容のハッシュ（システムプロンプトを変えたら別キーになるように）"""
+    try:
+        with open(MODELFILE_PATH, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    except OSError:
+        return "none"
+
+
+_MODELFILE_HASH = _modelfile_hash()
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角や空白の違いを吸収したキャッシュ用の文字列"""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+class TranslationCache:
+    """TTL付きのLRU翻訳キャッシュ。db_path を指定すると SQLite にも保存する"""
+
+    def __init__(self, max_entries: int = CACHE_SIZE, ttl: float = CACHE_TTL, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            self._db = sqlite3.connect(db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def make_key(self, text: str, source_lang: str, target_lang: str, model: str) -> str:
+        raw = "\x1f".join((model, _MODELFILE_HASH, source_lang, target_lang, normalize_text(text)))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            row = self._db.execute(
+                "SELECT value, created FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                entry = (row[0], row[1])
+                self._store(key, entry)
+
+        if entry is None or now - entry[1] > self.ttl:
+            if entry is not None:
+                self._delete(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: str) -> None:
+        entry = (value, time.time())
+        self._store(key, entry)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO translations (key, value, created) VALUES (?, ?, ?)",
+                (key, entry[0], entry[1]),
+            )
+            self._db.commit()
+
+    def clear(self) -> None:
+        """メモリ上のエントリを消す（SQLite 側は残す）"""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _store(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM translations WHERE key = ?", (key,))
+            self._db.commit()
+
+
+# Bot 全体で共有するキャッシュ
+cache = TranslationCache(db_path=CACHE_DB)
+metrics.add_collector("translation_cache", cache.stats)
@@ -1,19 +1,79 @@
 import re
+from typing import Dict, NamedTuple
+
+# 文字種ごとの Unicode 範囲（両端を含む）
+SCRIPT_RANGES = {
+    "hiragana": [(0x3040, 0x309F)],
+    "katakana": [(0x30A0, 0x30FF)],
+    "hangul": [(0x3130, 0x318F), (0x1100, 0x11FF), (0xA960, 0xA97F), (0xAC00, 0xD7AF), (0xD7B0, 0xD7FF)],
+    "han": [(0x4E00, 0x9FFF), (0x3400, 0x4DBF), (0xF900, 0xFAFF)],
+    "latin": [(0x41, 0x5A), (0x61, 0x7A)],
+}
+SCRIPTS = list(SCRIPT_RANGES)
+
+# 判定から除外する部分（URL・メンション・チャンネル・カスタム絵文字・タイムスタンプ）
+RE_IGNORE = re.compile(r"https?://\S+|<a?:\w+:\d+>|<[@#][!&]?\d+>|<t:\d+(?::\w)?>")
+
+# 文字種の印（私用領域の先頭から SCRIPTS の順に使う）
+MARK_BASE = 0xE000
+MARKS = [chr(MARK_BASE + index) for index in range(len(SCRIPTS))]
+# ASCII のうちラテン文字以外（ASCII だけのメッセージはこれを消した長さがラテン文字の数）
+NON_LATIN_ASCII = bytes(b for b in range(128) if not chr(b).isalpha())
+# 少ない方の言語がこの割合以上なら混在とみなす
+MIXED_THRESHOLD = 0.2
+
+
+def _build_table():
+    """str.translate 用の表（対象の文字は文字種ごとの印に置き換え、それ以外は消す）。
+
+    印には私用領域の文字を使い、元の文にある同じ文字は消しておく。
+    基本多言語面より後ろの文字（絵文字など）は表の範囲外なのでそのまま残るが、印とは一致しない。
+    """
+    table = [None] * 0x10000
+    for index, ranges in enumerate(SCRIPT_RANGES.values()):
+        for start, end in ranges:
+            table[start:end + 1] = [MARK_BASE + index] * (end - start + 1)
+    return tuple(table)
+
+
+TRANSLATE_TABLE = _build_table()
+
+
+class LanguageResult(NamedTuple):
+    language: str       # "japanese" / "korean" / "unknown"
+    confidence: float   # 判定した言語の文字が全体に占める割合
+    ratios: Dict[str, float]
+    mixed: bool         # 日本語と韓国語が混在しているか
+
+
+def count_scripts(text: str) -> Dict[str, int]:
+    """文字種ごとの文字数を数える（表で1回置き換えてから、印ごとに str.count で数える）"""
+    if text.isascii():
+        counts = dict.fromkeys(SCRIPTS, 0)
+        counts["latin"] = len(text.encode("ascii").translate(None, NON_LATIN_ASCII))
+        return counts
+    marked = text.translate(TRANSLATE_TABLE)
+    return {script: marked.count(mark) for script, mark in zip(SCRIPTS, MARKS)}
+
+
+def analyze_language(text: str) -> LanguageResult:
+    """メッセージの言語を判定する（URL・メンション・カスタム絵文字は除外）"""
+    if "://" in text or "<" in text:
+        text = RE_IGNORE.sub(" ", text)
+    counts = count_scripts(text)
+    total = sum(counts.values())
+    ratios = {script: (n / total if total else 0.0) for script, n in counts.items()}
+
+    japanese = counts["hiragana"] + counts["katakana"] + counts["han"]
+    korean = counts["hangul"]
+    if japanese == 0 and korean == 0:
+        return LanguageResult("unknown", 0.0, ratios, False)
+
+    language = "korean" if korean > japanese else "japanese"
+    confidence = max(japanese, korean) / total
+    mixed = min(japanese, korean) / (japanese + korean) >= MIXED_THRESHOLD
+    return LanguageResult(language, confidence, ratios, mixed)
 
-RE_HIRAGANA = re.compile(r"[\u3040-\u309F]")
-RE_KATAKANA = re.compile(r"[\u30A0-\u30FF]")
-RE_HANGUL = re.compile(r"[\u3130-\u318F\u1100-\u11FF\uA960-\uA97F\uAC00-\uD7AF\uD7B0-\uD7FF]")
-RE_CJK = re.compile(r"[\u4E00-\u9FFF\u3400-\u4DBF\uF900-\uFAFF]")
 
 def detect_language(text):
-    has_hiragana = bool(RE_HIRAGANA.search(text))
-    has_katakana = bool(RE_KATAKANA.search(text))
-    has_hangul = bool(RE_HANGUL.search(text))
-    has_cjk = bool(RE_CJK.search(text))
-
-    if has_hangul:
-        return "korean"
-    elif has_hiragana or has_katakana or has_cjk:
-        return "japanese"
-    else:
-        return "unknown"
\ No newline at end of file
+    return analyze_language(text).language
@@ -1,90 +1,410 @@
 import discord
 import asyncio
-import os
-from dotenv import load_dotenv
-from typing import Optional, Dict, List
+import time
+from urllib.parse import parse_qs, urlparse
+from settings import settings
+from typing import Optional, Dict, List, Set
 from collections import deque
-import yt_dlp
 
-# 環境変数の読み込み
-load_dotenv()
+import audio_cache
+import music_cache
+import ytdl_executor
+from metrics import metrics
+from outbound import outbox
 
-# ギルドごとの音楽キュー
-music_queues: Dict[int, deque] = {}
-# 現在再生中の情報
-now_playing: Dict[int, dict] = {}
+# 再生中に音声URLを先読みしておく曲数
+PREFETCH_COUNT = settings.get_int("MUSIC_PREFETCH_COUNT", 2)
+# URLに有効期限が書かれていない場合の有効期間（秒）
+STREAM_URL_TTL = 3600
+# 期限切れ直前のURLは使わない（秒）
+STREAM_URL_MARGIN = 300
+# 再生リストは最初にこの曲数だけ読み込んで再生を始める
+PLAYLIST_FIRST_PAGE = settings.get_int("MUSIC_PLAYLIST_FIRST_PAGE", 10)
+# 続きを読み込む1回あたりの最大曲数（ページは倍々に大きくする）
+PLAYLIST_MAX_PAGE = settings.get_int("MUSIC_PLAYLIST_MAX_PAGE", 200)
+# 再生できなかった曲を再試行する回数（それでも失敗したらスキップ）
+MAX_RETRIES = settings.get_int("MUSIC_MAX_RETRIES", 1)
+# 再試行までの待ち時間（秒）
+RETRY_DELAY = 1.0
+# キューが空のままこの秒数が過ぎたらVCから切断する（0で無効）
+IDLE_TIMEOUT = settings.get_float("MUSIC_IDLE_TIMEOUT", 300)
 
-def get_queue(guild_id: int) -> deque:
-    """ギルドのキューを取得（なければ作成）"""
-    if guild_id not in music_queues:
-        music_queues[guild_id] = deque()
-    return music_queues[guild_id]
 
+class Song:
+    """キューに積む1曲。チャンネルとリクエストした人はIDだけ持つ"""
 
-async def play_next(guild: discord.Guild, voice_client: discord.VoiceClient) -> None:
-    """キューから次の曲を再生"""
-    queue = get_queue(guild.id)
-    
-    if len(queue) == 0:
-        now_playing.pop(guild.id, None)
-        return
-    
-    # 次の曲を取得
-    next_song = queue.popleft()
-    now_playing[guild.id] = next_song
-    
-    try:
-        # yt-dlp で音声URL取得
-        ytdl_format_options = {
-            'format': 'bestaudio/best',
-            'noplaylist': True,
-            'quiet': True,
-            'no_warnings': True,
-            'default_search': 'auto',
-            'source_address': '0.0.0.0',
-        }
-        
-        ffmpeg_options = {
-            'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-            'options': '-vn'
+    __slots__ = ('url', 'title', 'duration', 'channel_id', 'requester_id', 'prefetch')
+
+    def __init__(self, url: str, title: str, duration: int, channel_id: int, requester_id: int):
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.channel_id = channel_id
+        self.requester_id = requester_id
+        # 先読み中・先読み済みの音声URL
+        self.prefetch: Optional[asyncio.Future] = None
+
+
+ffmpeg_options = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
+
+
+class GuildPlayer:
+    """ギルドごとの再生担当。キューと再生ループのタスクを持ち、他のギルドとは独立して動く"""
+
+    def __init__(self, guild: discord.Guild):
+        self.guild = guild
+        self.queue: deque = deque()
+        self.current: Optional[Song] = None
+        # 再生リストの続きを読み込み中のタスク
+        self.ingest_tasks: Set[asyncio.Task] = set()
+        self.metrics = {
+            'played': 0,
+            'errors': 0,
+            'extract_count': 0,
+            'extract_total': 0.0,
+            'extract_max': 0.0,
+            'gap_count': 0,
+            'gap_total': 0.0,
+            'gap_max': 0.0,
+            'ffmpeg_active': 0,
+            'ffmpeg_started': 0,
         }
-        
-        with yt_dlp.YoutubeDL(ytdl_format_options) as ydl:
-            info = ydl.extract_info(next_song['url'], download=False)
-            audio_url = info['url']
-        
-        # 再生
-        source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options)
-        
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # 直前の曲が終わった時刻（曲間の計測用。キューが空になったらリセット）
+        self._last_end: Optional[float] = None
+        self._last_channel_id: Optional[int] = None
+
+    def enqueue(self, songs: List[Song]) -> None:
+        """曲をキューに足し、再生ループが止まっていれば起動する"""
+        self.queue.extend(songs)
+        self.prefetch()
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def clear(self) -> None:
+        """キューと読み込み中の再生リストを捨てる（再生中の曲はそのまま）"""
+        for task in self.ingest_tasks:
+            task.cancel()
+        self.ingest_tasks.clear()
+        self.queue.clear()
+
+    def stop(self) -> None:
+        """再生ループを止める"""
+        self.clear()
+        if self._task is not None:
+            self._task.cancel()
+        self.current = None
+
+    def prefetch(self) -> None:
+        """キューの先頭 PREFETCH_COUNT 曲の音声URLをバックグラウンドで取得しておく"""
+        for song in [self.queue[i] for i in range(min(PREFETCH_COUNT, len(self.queue)))]:
+            pending = song.prefetch
+            if pending is not None and not pending.done():
+                continue
+            if pending is not None and pending.done() and not pending.cancelled() and pending.exception() is None:
+                stream = pending.result()
+                if stream is None or _stream_is_fresh(stream):
+                    continue
+            song.prefetch = asyncio.ensure_future(_prepare(song))
+            # 使われずに捨てられた場合の "exception was never retrieved" を防ぐ
+            song.prefetch.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def _run(self) -> None:
+        """キューが空になるまで1曲ずつ再生する。空のまま IDLE_TIMEOUT 秒たったら切断して終わる"""
+        while True:
+            if not self.queue:
+                self._last_end = None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), IDLE_TIMEOUT or None)
+                except asyncio.TimeoutError:
+                    await self._disconnect_idle()
+                    return
+                continue
+
+            voice_client = self.guild.voice_client
+            if voice_client is None or not voice_client.is_connected():
+                self.clear()
+                return
+
+            song = self.queue.popleft()
+            self.current = song
+            self._last_channel_id = song.channel_id
+            try:
+                await self._play(song, voice_client)
+            except Exception as e:
+                # 想定外のエラーでもループは止めない（他の曲・他のギルドに影響させない）
+                self.metrics['errors'] += 1
+                print(f"[{self.guild.id}] 再生ループのエラー: {e}")
+            finally:
+                self.current = None
+
+    async def _play(self, song: Song, voice_client: discord.VoiceClient) -> None:
+        channel = self.guild.get_channel_or_thread(song.channel_id)
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                # 音声ソース取得（保存済み・先読み済みならすぐ返る）
+                started = time.monotonic()
+                source = await open_source(song)
+                self._observe('extract', time.monotonic() - started)
+                break
+            except Exception as e:
+                self.metrics['errors'] += 1
+                print(f"[{self.guild.id}] 再生エラー ({attempt + 1}/{MAX_RETRIES + 1}): {e}")
+                if attempt == MAX_RETRIES:
+                    if channel:
+                        await outbox.send(channel, f"再生エラー: {song.title} をスキップします（{e}）")
+                    return
+                # 先読みした結果は使わずに取り直す
+                song.prefetch = None
+                await asyncio.sleep(RETRY_DELAY)
+
+        loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+
         def after_playing(error):
-            if error:
-                print(f"Player error: {error}")
-            # 次の曲を再生（asyncio loop で実行）
-            coro = play_next(guild, voice_client)
-            asyncio.run_coroutine_threadsafe(coro, voice_client.loop)
-        
+            # 音声スレッドから呼ばれるのでイベントループに戻す
+            loop.call_soon_threadsafe(self._on_track_end, finished, error)
+
+        if self._last_end is not None:
+            self._observe('gap', time.monotonic() - self._last_end)
         voice_client.play(source, after=after_playing)
-        
-        # チャンネルに通知
-        if next_song.get('channel'):
-            await next_song['channel'].send(f"🎵 再生中: {next_song['title']}")
-    
+        self.metrics['ffmpeg_active'] += 1
+        self.metrics['ffmpeg_started'] += 1
+        self.metrics['played'] += 1
+
+        # 再生中に次の曲のURLを先読みしておく
+        self.prefetch()
+
+        # チャンネルに通知（送信を待たずに再生を続ける）
+        if channel:
+            outbox.post(channel, f"🎵 再生中: {song.title}")
+
+        await finished.wait()
+
+    def _on_track_end(self, finished: asyncio.Event, error: Optional[Exception]) -> None:
+        self.metrics['ffmpeg_active'] -= 1
+        if error:
+            self.metrics['errors'] += 1
+            print(f"[{self.guild.id}] Player error: {error}")
+        self._last_end = time.monotonic()
+        finished.set()
+
+    async def _disconnect_idle(self) -> None:
+        voice_client = self.guild.voice_client
+        players.pop(self.guild.id, None)
+        if voice_client is None or not voice_client.is_connected():
+            return
+        await voice_client.disconnect()
+        channel = self.guild.get_channel_or_thread(self._last_channel_id) if self._last_channel_id else None
+        if channel:
+            await outbox.send(channel, f"💤 {IDLE_TIMEOUT:g}秒間再生がなかったため、ボイスチャンネルから切断しました。")
+
+    def _observe(self, name: str, seconds: float) -> None:
+        metrics.observe(f'music_{name}_seconds', seconds)
+        self.metrics[f'{name}_count'] += 1
+        self.metrics[f'{name}_total'] += seconds
+        self.metrics[f'{name}_max'] = max(self.metrics[f'{name}_max'], seconds)
+
+    def stats(self) -> dict:
+        m = self.metrics
+        return {
+            'queued': len(self.queue),
+            'playing': self.current is not None,
+            'played': m['played'],
+            'errors': m['errors'],
+            'extract_avg': m['extract_total'] / m['extract_count'] if m['extract_count'] else 0.0,
+            'extract_max': m['extract_max'],
+            'gap_avg': m['gap_total'] / m['gap_count'] if m['gap_count'] else 0.0,
+            'gap_max': m['gap_max'],
+            'ffmpeg_active': m['ffmpeg_active'],
+            'ffmpeg_started': m['ffmpeg_started'],
+        }
+
+
+# ギルドごとの再生担当
+players: Dict[int, GuildPlayer] = {}
+
+
+def get_player(guild: discord.Guild) -> GuildPlayer:
+    """ギルドの再生担当を取得（なければ作成）"""
+    if guild.id not in players:
+        players[guild.id] = GuildPlayer(guild)
+    return players[guild.id]
+
+
+def stats() -> Dict[int, dict]:
+    """ギルドごとの再生の統計"""
+    return {guild_id: player.stats() for guild_id, player in players.items()}
+
+
+def _total_stats() -> dict:
+    # 全ギルドの合計（メトリクス用）
+    totals = {}
+    for s in stats().values():
+        for key in ('queued', 'played', 'errors', 'ffmpeg_active', 'ffmpeg_started'):
+            totals[key] = totals.get(key, 0) + s[key]
+    return totals
+
+
+metrics.add_collector('music', _total_stats)
+
+
+async def _resolve_stream(url: str) -> dict:
+    """再生用の音声URLを取得する（キャッシュになければ抽出プールで yt-dlp を実行）"""
+    key = music_cache.normalize_key(url, playlist=False)
+    stream = music_cache.streams.get(key)
+    if _stream_is_fresh(stream):
+        return stream
+
+    info = await ytdl_executor.extract_info(url, 'stream')
+    stream = _stream_from_info(info)
+    music_cache.streams.set(key, stream, stream['expires'] - STREAM_URL_MARGIN)
+    return stream
+
+
+def _compact_entries(raw_entries: list) -> List[dict]:
+    return [
+        {
+            'url': entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}",
+            'title': entry.get('title', 'Unknown'),
+            'duration': entry.get('duration', 0),
+        }
+        for entry in raw_entries if entry
+    ]
+
+
+async def _lookup(url: str) -> dict:
+    """!p のURLの曲名・長さ・再生リストの中身を取得する（キャッシュ優先）
+
+    再生リストは先頭 PLAYLIST_FIRST_PAGE 曲だけ取得する。続きがある場合は 'partial' を付けて返し、
+    残りは _ingest_playlist が読み込んでからキャッシュする。
+    """
+    key = music_cache.normalize_key(url)
+    info = music_cache.metadata.get(key)
+    if info is not None:
+        return info
+
+    raw = await ytdl_executor.extract_info(url, 'playlist', items=f"1-{PLAYLIST_FIRST_PAGE}")
+    if 'entries' in raw:
+        raw_entries = raw['entries'] or []
+        info = {'title': raw.get('title', 'Unknown Playlist'), 'entries': _compact_entries(raw_entries)}
+        if len(raw_entries) >= PLAYLIST_FIRST_PAGE:
+            info['partial'] = True
+            info['count'] = raw.get('playlist_count')
+            return info
+    else:
+        info = {'title': raw.get('title', 'Unknown'), 'duration': raw.get('duration', 0)}
+        # 単一動画は取得済みの情報に音声URLが含まれているので、そのまま再生用に保存する
+        if raw.get('url'):
+            stream = _stream_from_info(raw)
+            music_cache.streams.set(music_cache.normalize_key(url, playlist=False), stream, stream['expires'] - STREAM_URL_MARGIN)
+
+    music_cache.metadata.set(key, info, time.time() + music_cache.METADATA_TTL)
+    return info
+
+
+async def _ingest_playlist(player: GuildPlayer, url: str, info: dict, channel_id: int, requester_id: int,
+                           loading_msg: discord.Message) -> None:
+    """再生リストの残りをページごとに読み込んでキューに足していく（その間も再生は続く）"""
+    title = info['title']
+    entries = list(info['entries'])
+    size = PLAYLIST_FIRST_PAGE
+
+    try:
+        while True:
+            start = len(entries) + 1
+            size = min(size * 2, PLAYLIST_MAX_PAGE)
+            raw = await ytdl_executor.extract_info(url, 'playlist', items=f"{start}-{start + size - 1}")
+            raw_entries = raw.get('entries') or []
+            page = _compact_entries(raw_entries)
+            entries.extend(page)
+            player.enqueue([Song(e['url'], e['title'], e['duration'], channel_id, requester_id) for e in page])
+            if len(raw_entries) < size:
+                break
+            # 途中経過（送る前に次のページが読み込まれたら古い方は送らない）
+            outbox.edit(loading_msg, f"⏳ 再生リスト「{title}」を読み込み中... {len(entries)}曲", progress=True)
     except Exception as e:
-        print(f"再生エラー: {e}")
-        if next_song.get('channel'):
-            await next_song['channel'].send(f"再生エラー: {e}")
-        # エラーでも次の曲を試す
-        await play_next(guild, voice_client)
+        print(f"再生リスト読み込みエラー: {e}")
+        await outbox.edit(loading_msg, f"⚠️ 再生リスト「{title}」の読み込みを{len(entries)}曲目で中断しました: {e}")
+        return
+
+    music_cache.metadata.set(
+        music_cache.normalize_key(url), {'title': title, 'entries': entries},
+        time.time() + music_cache.METADATA_TTL,
+    )
+    await outbox.edit(loading_msg, f"✅ 再生リスト「{title}」の{len(entries)}曲をすべてキューに追加しました。")
+
+
+def _stream_from_info(info: dict) -> dict:
+    audio_url = info['url']
+
+    # googlevideo のURLは expire パラメータに有効期限（UNIX時刻）が入っている
+    expire = parse_qs(urlparse(audio_url).query).get('expire')
+    expires = float(expire[0]) if expire else time.time() + STREAM_URL_TTL
+    # acodec が opus なら再エンコードせずにそのまま Discord に渡せる
+    return {'url': audio_url, 'expires': expires, 'acodec': info.get('acodec')}
+
+
+def _stream_is_fresh(stream: Optional[dict]) -> bool:
+    return stream is not None and stream['expires'] - STREAM_URL_MARGIN > time.time()
+
+
+async def _prepare(song: Song) -> Optional[dict]:
+    """音声URLを取得し、音声キャッシュが有効なら保存も始める（保存済みなら何もしない）"""
+    key = music_cache.normalize_key(song.url, playlist=False)
+    if audio_cache.cache is not None and key in audio_cache.cache:
+        return None
+    stream = await _resolve_stream(song.url)
+    if audio_cache.cache is not None:
+        audio_cache.cache.schedule(key, stream, song.duration)
+    return stream
+
+
+async def get_stream(song: Song) -> dict:
+    """先読み済みなら（期限内であれば）その音声URLを、なければ今取得したものを返す"""
+    pending = song.prefetch
+    if pending is not None:
+        try:
+            stream = await pending
+            if _stream_is_fresh(stream):
+                return stream
+        except Exception as e:
+            print(f"先読みエラー: {e}")
+
+    return await _resolve_stream(song.url)
+
+
+async def open_source(song: Song) -> discord.AudioSource:
+    """再生用の音声ソースを作る（保存済みのファイル > 配信URL）
+
+    Opus の音声は FFmpeg でコンテナだけ入れ替えて渡し、PCM へのデコードと再エンコードを省く。
+    """
+    if audio_cache.cache is not None:
+        path = audio_cache.cache.get(music_cache.normalize_key(song.url, playlist=False))
+        if path:
+            return discord.FFmpegOpusAudio(path, codec='copy')
+
+    stream = await get_stream(song)
+    if stream.get('acodec') == 'opus':
+        return discord.FFmpegOpusAudio(stream['url'], codec='copy', **ffmpeg_options)
+    return discord.FFmpegPCMAudio(stream['url'], **ffmpeg_options)
 
 
 async def play_url_from_message(message: discord.Message, url: str) -> None:
     """メッセージ送信者のいるVCで指定URLの音声を再生する。
 
-    message.guild.voice_client を使って接続・再生を行う。エラー時はメッセージで通知する。
+    message.guild.voice_client を使って接続し、曲はギルドの再生担当のキューに入れる。エラー時はメッセージで通知する。
     """
     # ユーザーがVCに参加しているか確認
     if not message.author.voice or not message.author.voice.channel:
-        await message.channel.send("VCに参加してから実行してください。")
+        await outbox.send(message.channel, "VCに参加してから実行してください。")
         return
 
     channel = message.author.voice.channel
@@ -99,77 +419,55 @@ async def play_url_from_message(message: discord.Message, url: str) -> None:
             await voice_client.move_to(channel)
 
         # 曲情報を取得
-        loading_msg = await message.channel.send("🔍 曲情報を取得中...")
+        loading_msg = await outbox.send(message.channel, "🔍 曲情報を取得中...")
         
-        ytdl_format_options = {
-            'format': 'bestaudio/best',
-            'noplaylist': False,  # 再生リストを許可
-            'quiet': True,
-            'no_warnings': True,
-            'default_search': 'auto',
-            'source_address': '0.0.0.0',
-            'extract_flat': 'in_playlist',  # 再生リスト内の動画情報を高速取得
-        }
+        # 抽出はプールで実行するので、巨大な再生リストでも翻訳などの処理は止まらない
+        with metrics.stage('music_lookup'):
+            info = await _lookup(url)
+        player = get_player(message.guild)
+        idle = player.current is None and not player.queue
+
+        # 再生リストかどうか確認
+        if 'entries' in info:
+            # 再生リスト（読み込めた分だけ先にキューに入れて再生を始める）
+            playlist_title = info.get('title', 'Unknown Playlist')
+            player.enqueue([
+                Song(entry['url'], entry['title'], entry['duration'], message.channel.id, message.author.id)
+                for entry in info['entries']
+            ])
+
+            if info.get('partial'):
+                total = f"全{info['count']}曲" if info.get('count') else "残り"
+                status = f"{len(info['entries'])}曲を追加しました（{total}を読み込み中...）"
+                task = asyncio.create_task(_ingest_playlist(
+                    player, url, info, message.channel.id, message.author.id, loading_msg,
+                ))
+                player.ingest_tasks.add(task)
+                task.add_done_callback(player.ingest_tasks.discard)
+            else:
+                status = f"{len(info['entries'])}曲を追加しました"
+
+            if idle:
+                await outbox.edit(loading_msg, f"✅ 再生リスト「{playlist_title}」から{status}。再生を開始します。")
+            else:
+                await outbox.edit(loading_msg, f"✅ 再生リスト「{playlist_title}」から{status}。")
         
-        with yt_dlp.YoutubeDL(ytdl_format_options) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            # 再生リストかどうか確認
-            if 'entries' in info:
-                # 再生リスト
-                playlist_title = info.get('title', 'Unknown Playlist')
-                entries = info['entries']
-                
-                await loading_msg.edit(content=f"📋 再生リスト「{playlist_title}」を処理中... ({len(entries)}曲)")
-                
-                queue = get_queue(message.guild.id)
-                added_count = 0
-                
-                for entry in entries:
-                    if entry:  # エントリーが有効な場合
-                        song_info = {
-                            'url': entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}",
-                            'title': entry.get('title', 'Unknown'),
-                            'duration': entry.get('duration', 0),
-                            'channel': message.channel,
-                            'requester': message.author
-                        }
-                        queue.append(song_info)
-                        added_count += 1
-                
-                # 再生中でなければ再生開始
-                if not voice_client.is_playing() and not voice_client.is_paused():
-                    await loading_msg.edit(content=f"✅ 再生リスト「{playlist_title}」から{added_count}曲を追加して再生を開始します。")
-                    await play_next(message.guild, voice_client)
-                else:
-                    await loading_msg.edit(content=f"✅ 再生リスト「{playlist_title}」から{added_count}曲をキューに追加しました。")
+        else:
+            # 単一の動画
+            title = info.get('title', 'Unknown')
+            duration = info.get('duration', 0)
             
+            # キューに追加（再生中でなければ再生担当がすぐに再生を始める）
+            player.enqueue([Song(url, title, duration, message.channel.id, message.author.id)])
+
+            if idle:
+                await outbox.edit(loading_msg, f"✅ 再生を開始します: {title}")
             else:
-                # 単一の動画
-                title = info.get('title', 'Unknown')
-                duration = info.get('duration', 0)
-                
-                # キューに追加
-                queue = get_queue(message.guild.id)
-                song_info = {
-                    'url': url,
-                    'title': title,
-                    'duration': duration,
-                    'channel': message.channel,
-                    'requester': message.author
-                }
-                queue.append(song_info)
-                
-                # 再生中でなければ再生開始
-                if not voice_client.is_playing() and not voice_client.is_paused():
-                    await loading_msg.edit(content=f"✅ 再生を開始します: {title}")
-                    await play_next(message.guild, voice_client)
-                else:
-                    position = len(queue)
-                    await loading_msg.edit(content=f"✅ キューに追加しました: {title}\n📝 キュー位置: {position}")
+                position = len(player.queue)
+                await outbox.edit(loading_msg, f"✅ キューに追加しました: {title}\n📝 キュー位置: {position}")
 
     except Exception as e:
-        await message.channel.send(f"エラー: {e}")
+        await outbox.send(message.channel, f"エラー: {e}")
 
 
 async def skip_song(message: discord.Message) -> None:
@@ -177,15 +475,15 @@ async def skip_song(message: discord.Message) -> None:
     voice_client: Optional[discord.VoiceClient] = message.guild.voice_client
     
     if not voice_client or not voice_client.is_connected():
-        await message.channel.send("Botはボイスチャンネルに接続していません。")
+        await outbox.send(message.channel, "Botはボイスチャンネルに接続していません。")
         return
     
     if not voice_client.is_playing():
-        await message.channel.send("現在再生中の曲はありません。")
+        await outbox.send(message.channel, "現在再生中の曲はありません。")
         return
     
     voice_client.stop()
-    await message.channel.send("⏭️ 曲をスキップしました。")
+    await outbox.send(message.channel, "⏭️ 曲をスキップしました。")
 
 
 async def pause_song(message: discord.Message) -> None:
@@ -193,19 +491,19 @@ async def pause_song(message: discord.Message) -> None:
     voice_client: Optional[discord.VoiceClient] = message.guild.voice_client
     
     if not voice_client or not voice_client.is_connected():
-        await message.channel.send("Botはボイスチャンネルに接続していません。")
+        await outbox.send(message.channel, "Botはボイスチャンネルに接続していません。")
         return
     
     if voice_client.is_paused():
-        await message.channel.send("既に一時停止中です。")
+        await outbox.send(message.channel, "既に一時停止中です。")
         return
     
     if not voice_client.is_playing():
-        await message.channel.send("現在再生中の曲はありません。")
+        await outbox.send(message.channel, "現在再生中の曲はありません。")
         return
     
     voice_client.pause()
-    await message.channel.send("⏸️ 再生を一時停止しました。")
+    await outbox.send(message.channel, "⏸️ 再生を一時停止しました。")
 
 
 async def resume_song(message: discord.Message) -> None:
@@ -213,47 +511,47 @@ async def resume_song(message: discord.Message) -> None:
     voice_client: Optional[discord.VoiceClient] = message.guild.voice_client
     
     if not voice_client or not voice_client.is_connected():
-        await message.channel.send("Botはボイスチャンネルに接続していません。")
+        await outbox.send(message.channel, "Botはボイスチャンネルに接続していません。")
         return
     
     if not voice_client.is_paused():
-        await message.channel.send("一時停止中ではありません。")
+        await outbox.send(message.channel, "一時停止中ではありません。")
         return
     
     voice_client.resume()
-    await message.channel.send("▶️ 再生を再開しました。")
+    await outbox.send(message.channel, "▶️ 再生を再開しました。")
 
 
 async def show_queue(message: discord.Message) -> None:
     """キューを表示"""
-    queue = get_queue(message.guild.id)
-    current = now_playing.get(message.guild.id)
+    player = get_player(message.guild)
+    queue = player.queue
+    current = player.current
     
     if not current and len(queue) == 0:
-        await message.channel.send("キューは空です。")
+        await outbox.send(message.channel, "キューは空です。")
         return
     
     msg = "📜 **音楽キュー**\n\n"
     
     if current:
-        msg += f"🎵 **現在再生中:**\n{current['title']}\n\n"
+        msg += f"🎵 **現在再生中:**\n{current.title}\n\n"
     
     if len(queue) > 0:
         msg += "**次の曲:**\n"
-        for i, song in enumerate(list(queue)[:10], 1):
-            msg += f"{i}. {song['title']}\n"
+        for i in range(min(10, len(queue))):
+            msg += f"{i + 1}. {queue[i].title}\n"
         
         if len(queue) > 10:
             msg += f"\n...他 {len(queue) - 10} 曲"
     
-    await message.channel.send(msg)
+    await outbox.send(message.channel, msg)
 
 
 async def clear_queue(message: discord.Message) -> None:
     """キューをクリア"""
-    queue = get_queue(message.guild.id)
-    queue.clear()
-    await message.channel.send("🗑️ キューをクリアしました。")
+    get_player(message.guild).clear()
+    await outbox.send(message.channel, "🗑️ キューをクリアしました。")
 
 
 async def stop_and_disconnect(guild: discord.Guild) -> None:
@@ -261,29 +559,47 @@ async def stop_and_disconnect(guild: discord.Guild) -> None:
     voice_client: Optional[discord.VoiceClient] = guild.voice_client
     if voice_client:
         try:
+            # 再生ループを止めてキューもクリア
+            player = players.pop(guild.id, None)
+            if player is not None:
+                player.stop()
+
             if voice_client.is_playing():
                 voice_client.stop()
             
-            # キューもクリア
-            queue = get_queue(guild.id)
-            queue.clear()
-            now_playing.pop(guild.id, None)
-            
             await voice_client.disconnect()
         except Exception as e:
             print(f"切断エラー: {e}")
 
 
+async def show_music_stats(message: discord.Message) -> None:
+    """このギルドの再生の統計を表示"""
+    player = players.get(message.guild.id)
+    if player is None:
+        await outbox.send(message.channel, "このサーバーではまだ再生していません。")
+        return
+
+    s = player.stats()
+    await outbox.send(
+        message.channel,
+        "📈 **再生の統計**\n"
+        f"再生: {s['played']}曲 / キュー: {s['queued']}曲 / エラー: {s['errors']}回\n"
+        f"音声取得: 平均 {s['extract_avg']:.2f}秒 / 最大 {s['extract_max']:.2f}秒\n"
+        f"曲間: 平均 {s['gap_avg']:.2f}秒 / 最大 {s['gap_max']:.2f}秒\n"
+        f"FFmpeg: 実行中 {s['ffmpeg_active']} / 起動 {s['ffmpeg_started']}回"
+    )
+
+
 async def disconnect_from_message(message: discord.Message) -> None:
     """メッセージからVC切断"""
     voice_client: Optional[discord.VoiceClient] = message.guild.voice_client
     
     if not voice_client or not voice_client.is_connected():
-        await message.channel.send("Botはボイスチャンネルに接続していません。")
+        await outbox.send(message.channel, "Botはボイスチャンネルに接続していません。")
         return
     
     await stop_and_disconnect(message.guild)
-    await message.channel.send("👋 ボイスチャンネルから切断しました。")
+    await outbox.send(message.channel, "👋 ボイスチャンネルから切断しました。")
 
 
 # vc_music.py は単体で client.run を実行しない（main.py が実行する）
\ No newline at end of file
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from settings import settings
+import yt_dlp
+
+# 抽出に使うプール（"thread" または "process"）
+EXECUTOR_KIND = settings.get("YTDL_EXECUTOR", "thread")
+# ワーカー数
+WORKERS = settings.get_int("YTDL_WORKERS", 2)
+# 1回の抽出のタイムアウト（秒）
+TIMEOUT = settings.get_float("YTDL_TIMEOUT", 30)
+
+# 用途ごとの yt-dlp 設定
+PROFILES = {
+    # 再生用の音声URL取得
+    'stream': {
+        'format': 'bestaudio/best',
+        'noplaylist': True,
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'auto',
+        'source_address': '0.0.0.0',
+    },
+    # !p で渡されたURLの情報取得（再生リスト対応）
+    'playlist': {
+        'format': 'bestaudio/best',
+        'noplaylist': False,  # 再生リストを許可
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'auto',
+        'source_address': '0.0.0.0',
+        'extract_flat': 'in_playlist',  # 再生リスト内の動画情報を高速取得
+    },
+}
+
+# 結果に不要な大きい項目（プロセス間の受け渡しを軽くする）
+_DROP_KEYS = ('formats', 'thumbnails', 'automatic_captions', 'subtitles', 'requested_formats', 'heatmap')
+
+# ワーカーごとに使い回す YoutubeDL（スレッドプールでは共有しないようスレッドローカル）
+_local = threading.local()
+
+_executor: Optional[Executor] = None
+
+
+def _get_ydl(profile: str) -> yt_dlp.YoutubeDL:
+    instances = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+    if profile not in instances:
+        instances[profile] = yt_dlp.YoutubeDL(PROFILES[profile])
+    return instances[profile]
+
+
+def _extract(url: str, profile: str, items: Optional[str] = None) -> dict:
+    """ワーカー内で実行される抽出処理（items は再生リストの範囲 "1-50" など）"""
+    ydl = _get_ydl(profile)
+    # インスタンスは使い回すので、範囲指定は毎回上書きする
+    if items:
+        ydl.params['playlist_items'] = items
+    else:
+        ydl.params.pop('playlist_items', None)
+    info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    for key in _DROP_KEYS:
+        info.pop(key, None)
+    return info
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if EXECUTOR_KIND == 'process':
+            _executor = ProcessPoolExecutor(max_workers=WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="ytdl")
+    return _executor
+
+
+async def extract_info(url: str, profile: str = 'stream', timeout: float = TIMEOUT,
+                       items: Optional[str] = None) -> dict:
+    """yt-dlp の extract_info をプールで実行する。
+
+    timeout を超えるか呼び出し元がキャンセルされた場合は、まだ始まっていなければプールからも取り消す
+    （実行中の抽出は止められないので結果を捨てる）。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_executor(), _extract, url, profile, items)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"yt-dlp の処理が {timeout:g} 秒以内に終わりませんでした: {url}")
+
+
+def shutdown() -> None:
+    """プールを終了する（Bot終了時に呼ぶ）"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None